@@ -5,28 +5,33 @@
 ══════════════════════════════════════════
 """
 
-import os, sys, json, time, asyncio, traceback
+import os, sys, json, time, gzip, zlib, fcntl, random, shutil, struct, asyncio, itertools, subprocess, traceback
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, List
-from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, ExitStack
 
 import httpx
 import uvicorn
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, Request, Response
 from sqlalchemy import (
     Column, Integer, BigInteger, String, Text, Boolean, DateTime,
-    ForeignKey, select, delete, and_
+    ForeignKey, select, delete, update, and_, or_, case, func, text
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, relationship
 from telethon import TelegramClient, functions
 from telethon.sessions import StringSession
 from telethon.tl.functions.users import GetFullUserRequest
-from telethon.tl.types import Channel, Chat, PeerChannel, PeerUser, InputPeerUser
+from telethon.tl.types import (
+    Channel, Chat, User, PeerChannel, PeerUser, InputPeerUser,
+    InputMessagesFilterPhotoVideo, InputMessagesFilterDocument, InputMessagesFilterRoundVoice
+)
 from telethon.errors import (
-    FloodWaitError, SessionPasswordNeededError,
+    FloodWaitError, SessionPasswordNeededError, UnauthorizedError,
     PhoneCodeInvalidError, PhoneCodeExpiredError, PasswordHashInvalidError
 )
 
@@ -44,6 +49,90 @@ ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
 PORT = int(os.getenv("PORT", "8000"))
 DEFAULT_CREDITS = 3
 
+# Multi-worker mode: the process on PORT routes each update to worker uid % WORKERS
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8100"))  # workers listen on 127.0.0.1:BASE+i
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+IS_ROUTER = WORKERS > 1 and "WORKER_INDEX" not in os.environ
+
+# Bot API HTTP client (one pooled client for the whole process)
+BOT_HTTP_MAX_CONN = int(os.getenv("BOT_HTTP_MAX_CONN", "100"))
+BOT_HTTP_KEEPALIVE = int(os.getenv("BOT_HTTP_KEEPALIVE", "20"))
+BOT_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("BOT_HTTP_KEEPALIVE_EXPIRY", "60"))
+BOT_HTTP2 = os.getenv("BOT_HTTP2", "0") == "1"
+# Per-method timeouts in seconds; anything not listed uses "default"
+BOT_TIMEOUTS = {"default": 30.0, "sendMessage": 15.0, "editMessageText": 15.0,
+                "answerCallbackQuery": 5.0, "sendDocument": 120.0}
+
+# Outbound dispatcher: global token bucket + per-chat spacing + 429 backoff
+OUT_RATE = float(os.getenv("OUT_RATE", "30"))            # msgs/s across all chats
+OUT_BURST = int(os.getenv("OUT_BURST", "30"))
+OUT_BULK_RESERVE = int(os.getenv("OUT_BULK_RESERVE", "5"))  # tokens broadcasts leave for interactive sends
+OUT_BUCKET_FILE = os.getenv("OUT_BUCKET_FILE", "/tmp/shadowclean-out.bucket")  # shared by workers
+OUT_CHAT_INTERVAL = float(os.getenv("OUT_CHAT_INTERVAL", "1.0"))    # private chats
+OUT_GROUP_INTERVAL = float(os.getenv("OUT_GROUP_INTERVAL", "3.0"))  # groups (20/min)
+OUT_WORKERS = int(os.getenv("OUT_WORKERS", "16"))
+OUT_MAX_RETRY = int(os.getenv("OUT_MAX_RETRY", "5"))
+BCAST_PAGE = int(os.getenv("BCAST_PAGE", "500"))         # recipients read (and progress saved) per page
+BCAST_CONCURRENCY = int(os.getenv("BCAST_CONCURRENCY", "50"))  # sends in flight; the outbox sets the rate
+
+# Webhook intake: ack immediately, process from in-memory per-user FIFO queues
+UPD_CONSUMERS = int(os.getenv("UPD_CONSUMERS", "64"))     # handlers running at once (different users)
+UPD_QUEUE_MAX = int(os.getenv("UPD_QUEUE_MAX", "8000"))    # updates waiting, all users
+UPD_DEDUP_SIZE = int(os.getenv("UPD_DEDUP_SIZE", "20000"))
+UPD_DEDUP_TTL = int(os.getenv("UPD_DEDUP_TTL", "3600"))
+UPD_DRAIN_TIMEOUT = float(os.getenv("UPD_DRAIN_TIMEOUT", "10"))
+
+# Heavy jobs (stalk, scans, deletes, broadcasts) run on a bounded pool
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "50"))   # beyond this new jobs are refused
+
+# Telethon user client pool
+POOL_MAX = int(os.getenv("POOL_MAX", "200"))             # open MTProto connections
+POOL_IDLE = int(os.getenv("POOL_IDLE", "600"))           # disconnect after this many idle seconds
+POOL_REAP = int(os.getenv("POOL_REAP", "60"))            # idle sweep interval
+LOGIN_TTL = int(os.getenv("LOGIN_TTL", "600"))           # pending login kept connected this long per step
+ENT_CACHE_MAX = int(os.getenv("ENT_CACHE_MAX", "5000"))  # entities (id + access hash) kept per session
+
+# Conversation state (dialog step + scratch data per user)
+STATE_STORE = os.getenv("STATE_STORE", "memory")        # memory | sql (shared by workers, survives restarts)
+STATE_TTL = int(os.getenv("STATE_TTL", "86400"))
+STATE_MAX = int(os.getenv("STATE_MAX", "10000"))         # entries kept
+STATE_SWEEP = int(os.getenv("STATE_SWEEP", "300"))       # expiry sweep interval
+
+# User row cache (read-through) + write-behind profile fields
+USER_TTL = int(os.getenv("USER_TTL", "60"))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "50000"))
+USER_FLUSH = float(os.getenv("USER_FLUSH", "5"))         # profile updates written every N seconds
+CREDIT_FLUSH = float(os.getenv("CREDIT_FLUSH", "5"))     # credit events inserted every N seconds
+STATS_TTL = int(os.getenv("STATS_TTL", "300"))           # admin counters recounted in SQL this often
+
+# Footprint engine pacing (per Telegram account)
+FP_CONCURRENCY = int(os.getenv("FP_CONCURRENCY", "4"))    # groups processed at once
+FP_BATCH = 100                                             # channels.deleteMessages max ids
+FP_RATE = float(os.getenv("FP_RATE", "20"))               # account requests/s; FloodWaits halve it
+FP_BURST = int(os.getenv("FP_BURST", "20"))               # requests that may start at once
+FP_MIN_RATE = float(os.getenv("FP_MIN_RATE", "0.1"))
+FP_FLOOD_RETRIES = int(os.getenv("FP_FLOOD_RETRIES", "3"))
+FP_SCAN_CONCURRENCY = int(os.getenv("FP_SCAN_CONCURRENCY", "8"))
+FP_SCAN_MODE = os.getenv("FP_SCAN_MODE", "fast")          # fast = server-side counts, full = iterate
+FP_DIALOG_TTL = int(os.getenv("FP_DIALOG_TTL", "600"))    # per-user group list cache
+FP_HANDOFF_TTL = int(os.getenv("FP_HANDOFF_TTL", "900"))  # a scan this fresh drives the delete plan
+FP_HANDOFF_IDS = int(os.getenv("FP_HANDOFF_IDS", "2000")) # full scans keep ids of groups up to this size
+
+# Recurring auto-clean (opt-in per user)
+AUTO_EVERY_HOURS = int(os.getenv("AUTO_EVERY_HOURS", "168"))
+AUTO_JITTER = float(os.getenv("AUTO_JITTER", "0.1"))     # +- fraction of the interval
+AUTO_TICK = int(os.getenv("AUTO_TICK", "60"))            # scheduler poll, seconds
+AUTO_BATCH = int(os.getenv("AUTO_BATCH", "5"))           # max runs started per tick
+
+# Export (backup before delete): gzip'd JSONL parts, sent with sendDocument
+EXPORT_DIR = os.path.join(os.getenv("EXPORT_DIR", "/tmp/shadowclean-export"), f"w{WORKER_INDEX}")
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))  # Bot API upload limit is 50 MB
+EXPORT_GZ_LEVEL = int(os.getenv("EXPORT_GZ_LEVEL", "1"))  # fast; compression runs in a thread per page
+# Server-side filters whose search totals add up to "media" in a fast scan
+FP_MEDIA_FILTERS = [InputMessagesFilterPhotoVideo, InputMessagesFilterDocument, InputMessagesFilterRoundVoice]
+
 if not all([BOT_TOKEN, API_ID, API_HASH, DB_URL]):
     print("❌ Set: BOT_TOKEN, TELEGRAM_API_ID, TELEGRAM_API_HASH, DATABASE_URL"); sys.exit(1)
 
@@ -79,11 +168,22 @@ class UserDB(Base):
     lang = Column(String(5), default="fa")
     credits = Column(Integer, default=DEFAULT_CREDITS)
     is_banned = Column(Boolean, default=False)
+    blocked = Column(Boolean, default=False)  # bot blocked / account gone (403); cleared on next contact
     is_admin = Column(Boolean, default=False)
     total_used = Column(Integer, default=0)
     joined = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     sessions = relationship("SessionDB", back_populates="user", cascade="all, delete-orphan")
 
+class CreditEventDB(Base):
+    """Append-only credit ledger: one row per balance change (delta is NULL for an absolute set)."""
+    __tablename__ = "credit_events"
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, index=True)
+    delta = Column(Integer, nullable=True)
+    balance = Column(Integer)
+    reason = Column(String(20))  # job kind | refund | add | set
+    ts = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
 class SessionDB(Base):
     __tablename__ = "sessions"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -93,44 +193,397 @@ class SessionDB(Base):
     phone_hash = Column(String(255))
     authorized = Column(Boolean, default=False)
     expires = Column(DateTime(timezone=True))
+    entities = Column(Text, nullable=True)  # Fernet(zlib(JSON)) of the client's entity cache
     user = relationship("UserDB", back_populates="sessions")
 
+class JobDB(Base):
+    """Persisted long-running job (footprint delete, broadcast) so it can resume after a restart."""
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    chat_id = Column(BigInteger)
+    kind = Column(String(20))
+    lang = Column(String(5), default="fa")
+    params = Column(Text, default="{}")
+    status = Column(String(20), default="running")  # running | done | cancelled | failed
+    done = Column(Integer, default=0)
+    err = Column(Integer, default=0)
+    created = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+class JobGroupDB(Base):
+    """Per-group checkpoint of a job. Groups are walked newest -> oldest,
+    so last_msg_id is the lowest id handled so far (resume with max_id)."""
+    __tablename__ = "job_groups"
+    job_id = Column(Integer, ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True)
+    group_id = Column(BigInteger, primary_key=True)
+    title = Column(String(255))
+    last_msg_id = Column(Integer, default=0)
+    stage = Column(Integer, default=0)  # index into the job's server-side filter passes
+    done = Column(Integer, default=0)
+    err = Column(Integer, default=0)
+    status = Column(String(20), default="running")  # running | done
+
+class AutoCleanDB(Base):
+    """Opt-in recurring cleanup: delete my messages older than `days` every `every_hours`.
+    marks = {group_id: highest message id already removed}, so each run only looks above it."""
+    __tablename__ = "autoclean"
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(BigInteger)
+    lang = Column(String(5), default="fa")
+    days = Column(Integer, default=30)
+    every_hours = Column(Integer, default=AUTO_EVERY_HOURS)
+    enabled = Column(Boolean, default=True)
+    paused = Column(Boolean, default=False)  # no live session at a due run; resumes at the next login
+    next_run = Column(DateTime(timezone=True), index=True)
+    last_run = Column(DateTime(timezone=True), nullable=True)
+    marks = Column(Text, default="{}")
+
+class StateDB(Base):
+    """Conversation state when STATE_STORE=sql."""
+    __tablename__ = "states"
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text)
+    expires = Column(DateTime(timezone=True), index=True)
+
+class ScanDB(Base):
+    """Last footprint scan per user and group; max_id is the high-water mark for rescans."""
+    __tablename__ = "scans"
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    group_id = Column(BigInteger, primary_key=True)
+    title = Column(String(255))
+    count = Column(Integer, default=0)
+    media = Column(Integer, default=0)
+    text = Column(Integer, default=0)
+    max_id = Column(Integer, default=0)
+    updated = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+# Columns added after a table first shipped (create_all never alters existing tables)
+MIGRATIONS = [
+    "ALTER TABLE job_groups ADD COLUMN IF NOT EXISTS stage INTEGER DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS entities TEXT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked BOOLEAN DEFAULT FALSE",
+    "ALTER TABLE autoclean ADD COLUMN IF NOT EXISTS paused BOOLEAN DEFAULT FALSE",
+]
+
 engine = create_async_engine(DB_URL, pool_size=5, max_overflow=10, pool_pre_ping=True)
 DBS = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for m in MIGRATIONS: await conn.execute(text(m))
+
+def owned(col):
+    """SQL filter for rows whose user belongs to this worker (always true with one worker)."""
+    return col % WORKERS == WORKER_INDEX
+
 # ══════════════════════════════
 # STATE
 # ══════════════════════════════
-user_states: Dict[int, Dict] = {}
-def sset(uid, state, **kw): user_states[uid] = {"s": state, **kw}
-def sget(uid):
-    d = user_states.get(uid, {})
+class MemoryStates:
+    """Process-local state; entries expire after `ttl` seconds, oldest dropped beyond `size`."""
+    def __init__(self, ttl, size):
+        self.ttl, self.size = ttl, size
+        self.d: OrderedDict = OrderedDict()  # uid -> (expires, data), in set order
+
+    async def get(self, uid):
+        e = self.d.get(uid)
+        if e and e[0] > time.monotonic(): return e[1]
+        if e: del self.d[uid]
+        return None
+
+    async def set(self, uid, data):
+        self.d.pop(uid, None); self.d[uid] = (time.monotonic() + self.ttl, data)
+        while len(self.d) > self.size: self.d.popitem(last=False)
+
+    async def delete(self, uid): self.d.pop(uid, None)
+
+    async def sweep(self):
+        now = time.monotonic()  # one ttl for all, so set order is expiry order
+        while self.d and next(iter(self.d.values()))[0] <= now: self.d.popitem(last=False)
+
+class SqlStates:
+    """State rows in `states`: shared by every worker and kept across restarts.
+    Expired rows are ignored on read; sweep() deletes them and trims to `size`."""
+    def __init__(self, ttl, size):
+        self.ttl, self.size = ttl, size
+
+    async def get(self, uid):
+        async with DBS() as db:
+            r = await db.get(StateDB, uid)
+            if r and r.expires > datetime.now(timezone.utc): return json.loads(r.data)
+        return None
+
+    async def set(self, uid, data):
+        v = json.dumps(data, ensure_ascii=False); exp = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        async with DBS() as db:
+            await db.execute(pg_insert(StateDB).values(user_id=uid, data=v, expires=exp).on_conflict_do_update(
+                index_elements=[StateDB.user_id], set_={"data": v, "expires": exp}))
+            await db.commit()
+
+    async def delete(self, uid):
+        async with DBS() as db:
+            await db.execute(delete(StateDB).where(StateDB.user_id == uid)); await db.commit()
+
+    async def sweep(self):
+        async with DBS() as db:
+            await db.execute(delete(StateDB).where(StateDB.expires <= datetime.now(timezone.utc)))
+            over = select(StateDB.user_id).order_by(StateDB.expires.desc()).offset(self.size)
+            await db.execute(delete(StateDB).where(StateDB.user_id.in_(over)))
+            await db.commit()
+
+states = (SqlStates if STATE_STORE == "sql" else MemoryStates)(STATE_TTL, STATE_MAX)
+
+async def sset(uid, state, **kw): await states.set(uid, {"s": state, **kw})
+async def sget(uid):
+    d = await states.get(uid) or {}
     return d.get("s"), d
-def sdel(uid): user_states.pop(uid, None)
+async def supd(uid, **kw):
+    d = await states.get(uid) or {"s": None}
+    d.update(kw); await states.set(uid, d)
+async def sdel(uid): await states.delete(uid)
+
+async def sweep_states():
+    while True:
+        await asyncio.sleep(STATE_SWEEP)
+        try: await states.sweep()
+        except Exception as e: print(f"sweep_states error: {e}")
+        sweep_fp()
 
 # ══════════════════════════════
 # TELEGRAM API
 # ══════════════════════════════
-async def tg(method, **kw):
+# One keep-alive client shared by every call; opened/closed in lifespan.
+http_client: Optional[httpx.AsyncClient] = None
+
+def get_http():
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http2 = BOT_HTTP2
+        if http2:
+            try: import h2  # noqa: F401  (optional, pulled in by httpx[http2])
+            except ImportError: print("⚠️ BOT_HTTP2=1 but h2 is not installed, using HTTP/1.1"); http2 = False
+        http_client = httpx.AsyncClient(
+            http2=http2, timeout=BOT_TIMEOUTS["default"],
+            limits=httpx.Limits(max_connections=BOT_HTTP_MAX_CONN,
+                                max_keepalive_connections=BOT_HTTP_KEEPALIVE,
+                                keepalive_expiry=BOT_HTTP_KEEPALIVE_EXPIRY))
+    return http_client
+
+async def close_http():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose(); http_client = None
+
+async def tg(method, files=None, **kw):
+    """files = {field: path} sends multipart/form-data, streamed from disk."""
     try:
-        async with httpx.AsyncClient(timeout=30) as c:
-            r = await c.post(f"{BOT_API}/{method}", json=kw)
+        to = BOT_TIMEOUTS.get(method, BOT_TIMEOUTS["default"])
+        if not files:
+            r = await get_http().post(f"{BOT_API}/{method}", json=kw, timeout=to)
             return r.json()
+        data = {k: v if isinstance(v, str) else json.dumps(v) for k, v in kw.items()}
+        with ExitStack() as st:
+            fs = {k: (os.path.basename(p), st.enter_context(open(p, "rb"))) for k, p in files.items()}
+            r = await get_http().post(f"{BOT_API}/{method}", data=data, files=fs, timeout=to)
+        return r.json()
     except: return {"ok": False}
 
-async def send(cid, text, markup=None):
+# ══════════════════════════════
+# OUTBOUND DISPATCHER
+# ══════════════════════════════
+_tasks: set = set()
+
+def spawn(coro):
+    """create_task that keeps a reference until done and logs crashes."""
+    t = asyncio.create_task(coro); _tasks.add(t)
+    def _done(t):
+        _tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            e = t.exception(); print(f"❌ task: {e}\n{''.join(traceback.format_exception(e))}")
+    t.add_done_callback(_done); return t
+
+# Priority lanes: lower number goes first
+P_INTERACTIVE, P_PROGRESS, P_BULK = 0, 1, 2
+
+class TokenBucket:
+    """Global send budget: `rate` tokens/s, bursts up to `burst`."""
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = float(burst), time.monotonic()
+        self.paused_until = 0.0
+
+    def _try(self, need):
+        """Take a token if `need` are available; returns 0 or the seconds to wait."""
+        now = time.monotonic()
+        if now < self.paused_until: return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate); self.ts = now
+        need = min(need, self.burst)
+        if self.tokens >= need: self.tokens -= 1; return 0
+        return (need - self.tokens) / self.rate
+
+    async def take(self, reserve=0):
+        """Wait for a token, leaving `reserve` in the bucket for other callers."""
+        while wait := self._try(1 + reserve): await asyncio.sleep(wait)
+
+    def _pause(self, until):
+        self.paused_until = max(self.paused_until, until); return 0
+
+    def pause(self, sec): self._pause(time.monotonic() + sec)
+
+class SharedBucket(TokenBucket):
+    """TokenBucket whose state lives in a small file shared by all worker processes
+    (flock'd read-modify-write), so the bot's one global limit is not split per worker.
+    CLOCK_MONOTONIC is system-wide, so timestamps compare across processes."""
+    def __init__(self, path, rate, burst):
+        super().__init__(rate, burst)
+        self.path, self.fd = path, None
+
+    def _shared(self, fn, *a):
+        if self.fd is None: self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            raw = os.pread(self.fd, 24, 0)
+            if len(raw) == 24: self.tokens, self.ts, self.paused_until = struct.unpack("ddd", raw)
+            r = fn(*a)
+            os.pwrite(self.fd, struct.pack("ddd", self.tokens, self.ts, self.paused_until), 0)
+            return r
+        finally: fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _try(self, need): return self._shared(super()._try, need)
+    def _pause(self, until): return self._shared(super()._pause, until)
+
+def chat_interval(cid):
+    return OUT_CHAT_INTERVAL if cid > 0 else OUT_GROUP_INTERVAL
+
+class Outbox:
+    """Every Bot API call goes through here: per-chat FIFO queues -> priority queue -> N workers.
+
+    A chat is handed to a worker only when nothing is in flight for it and its
+    chat_interval() spacing has passed (a call_later re-arms it), so a busy chat
+    never ties up workers. All chats share one token bucket; bulk sends leave
+    OUT_BULK_RESERVE tokens in it for everything else. A 429 is retried after
+    parameters.retry_after instead of being dropped. A progress edit that is still
+    waiting is replaced by newer text, up to the moment it is sent.
+    """
+    def __init__(self, bucket, workers):
+        self.bucket = bucket
+        self.q: asyncio.PriorityQueue = asyncio.PriorityQueue()  # (prio, seq, cid, item) ready to send
+        self.seq = itertools.count()
+        self.n = workers; self.workers: List[asyncio.Task] = []
+        self.chats: Dict[int, deque] = {}    # cid -> items waiting, in order
+        self.armed: set = set()               # chats in q or waiting on their spacing timer
+        self.inflight: set = set()
+        self.chat_next: Dict[int, float] = {}
+        self.pending_edits: Dict[tuple, list] = {}
+        self.sent = self.retried = self.failed = 0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.n)]
+
+    async def stop(self):
+        for w in self.workers: w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True); self.workers = []
+
+    def stats(self):
+        return {"queued": self.q.qsize() + sum(len(d) for d in self.chats.values()), "chats": len(self.chats),
+                "sent": self.sent, "retried_429": self.retried, "failed": self.failed}
+
+    async def call(self, method, cid=None, prio=P_INTERACTIVE, coalesce=None, **kw):
+        if not self.workers: return await tg(method, **kw)  # dispatcher not running (scripts)
+        if coalesce is not None and coalesce in self.pending_edits:
+            item = self.pending_edits[coalesce]; item[2] = kw
+            return await asyncio.shield(item[3])
+        # item = [method, cid, kw, future, coalesce key, prio, seq, tries]
+        item = [method, cid, kw, asyncio.get_running_loop().create_future(), coalesce, prio, next(self.seq), 0]
+        if coalesce is not None: self.pending_edits[coalesce] = item
+        if cid is None: self.q.put_nowait((prio, item[6], None, item))
+        else: self.chats.setdefault(cid, deque()).append(item); self._arm(cid)
+        return await asyncio.shield(item[3])
+
+    def _arm(self, cid):
+        if cid in self.armed or cid in self.inflight or not self.chats.get(cid): return
+        self.armed.add(cid)
+        wait = self.chat_next.get(cid, 0) - time.monotonic()
+        if wait > 0: asyncio.get_running_loop().call_later(wait, self._ready, cid)
+        else: self._ready(cid)
+
+    def _ready(self, cid):
+        d = self.chats.get(cid)
+        if not d: self.armed.discard(cid); return
+        self.q.put_nowait((d[0][5], d[0][6], cid, None))  # ranked by the chat's oldest item
+
+    async def _worker(self):
+        while True:
+            _, _, cid, item = await self.q.get()
+            if cid is not None:
+                self.armed.discard(cid)
+                d = self.chats.get(cid)
+                if not d: continue
+                item = d.popleft(); self.inflight.add(cid)
+            try: await self._send(cid, item)
+            except Exception as e:
+                self.failed += 1
+                if not item[3].done(): item[3].set_result({"ok": False, "description": str(e)})
+            finally:
+                if cid is not None:
+                    self.inflight.discard(cid)
+                    if self.chats.get(cid): self._arm(cid)
+                    else: self.chats.pop(cid, None)
+                    if len(self.chat_next) > 10000:
+                        now = time.monotonic()
+                        self.chat_next = {k: v for k, v in self.chat_next.items() if v > now}
+
+    async def _send(self, cid, item):
+        method, _, _, fut, key, prio, seq, tries = item
+        await self.bucket.take(OUT_BULK_RESERVE if prio == P_BULK else 0)
+        # from here on a newer edit of this message is a new item
+        if key is not None and self.pending_edits.get(key) is item: del self.pending_edits[key]
+        if cid is not None: self.chat_next[cid] = time.monotonic() + chat_interval(cid)
+        r = await tg(method, **item[2])
+        if r.get("error_code") == 429 and tries < OUT_MAX_RETRY:
+            self.retried += 1; item[7] += 1
+            ra = float((r.get("parameters") or {}).get("retry_after", 1))
+            if key is not None: self.pending_edits.setdefault(key, item)
+            if cid is None:
+                self.bucket.pause(ra)
+                asyncio.get_running_loop().call_later(ra, self.q.put_nowait, (prio, seq, None, item))
+            else:
+                self.chat_next[cid] = time.monotonic() + ra; self.chats.setdefault(cid, deque()).appendleft(item)
+            return
+        if r.get("ok"): self.sent += 1
+        else: self.failed += 1
+        if not fut.done(): fut.set_result(r)
+
+# Bot API limits are per bot, so with several workers they all draw from one bucket file
+outbox = Outbox(SharedBucket(OUT_BUCKET_FILE, OUT_RATE, OUT_BURST) if WORKERS > 1 else TokenBucket(OUT_RATE, OUT_BURST),
+                OUT_WORKERS)
+
+async def send(cid, text, markup=None, prio=P_INTERACTIVE):
     p = {"chat_id": cid, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
     if markup: p["reply_markup"] = markup
-    return await tg("sendMessage", **p)
+    return await outbox.call("sendMessage", cid, prio, **p)
 
-async def edit(cid, mid, text, markup=None):
+async def edit(cid, mid, text, markup=None, prio=P_INTERACTIVE):
     p = {"chat_id": cid, "message_id": mid, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
     if markup: p["reply_markup"] = markup
-    try: return await tg("editMessageText", **p)
-    except: return await send(cid, text, markup)
+    # Progress edits of one message collapse into the latest text
+    key = (cid, mid) if prio == P_PROGRESS else None
+    try: return await outbox.call("editMessageText", cid, prio, coalesce=key, **p)
+    except: return await send(cid, text, markup, prio)
+
+def progress(cid, mid, text, markup=None):
+    """Fire-and-forget progress edit; never blocks the job that reports it."""
+    if mid: spawn(edit(cid, mid, text, markup, prio=P_PROGRESS))
+
+async def send_doc(cid, path, caption="", prio=P_INTERACTIVE):
+    return await outbox.call("sendDocument", cid, prio, files={"document": path},
+                             chat_id=cid, caption=caption, parse_mode="HTML")
 
 async def answer(cbid, text=""):
-    return await tg("answerCallbackQuery", callback_query_id=cbid, text=text)
+    return await outbox.call("answerCallbackQuery", None, P_INTERACTIVE, callback_query_id=cbid, text=text)
 
 # ══════════════════════════════
 # KEYBOARDS
@@ -172,32 +625,86 @@ def kb_groups_inline(groups, page=0, per_page=8, prefix="sg"):
 def kb_footprint(la, logged_in=False):
     if la == "en":
         rows = [
-            [{"text": "📊 Scan My Messages", "callback_data": "fp_scan"}],
+            [{"text": "📊 Scan My Messages", "callback_data": "fp_scan"},
+             {"text": "🔬 Full Scan", "callback_data": "fp_scan_full"}],
         ]
         if logged_in:
             rows.append([{"text": "🗑️ DELETE ALL MY MSGS", "callback_data": "fp_delete"}])
+            rows.append([{"text": "🎯 Selective delete", "callback_data": "fp_sel"},
+                         {"text": "🔁 Auto-clean", "callback_data": "fp_auto"}])
         else:
             rows.append([{"text": "📱 Login to Delete", "callback_data": "fp_login"}])
         rows.append([{"text": "🔙 Back", "callback_data": "back_main"}])
     else:
         rows = [
-            [{"text": "📊 اسکن پیام‌های من", "callback_data": "fp_scan"}],
+            [{"text": "📊 اسکن پیام‌های من", "callback_data": "fp_scan"},
+             {"text": "🔬 اسکن کامل", "callback_data": "fp_scan_full"}],
         ]
         if logged_in:
             rows.append([{"text": "🗑️ حذف همه پیام‌هام", "callback_data": "fp_delete"}])
+            rows.append([{"text": "🎯 حذف انتخابی", "callback_data": "fp_sel"},
+                         {"text": "🔁 پاکسازی خودکار", "callback_data": "fp_auto"}])
         else:
             rows.append([{"text": "📱 ورود برای حذف", "callback_data": "fp_login"}])
         rows.append([{"text": "🔙 بازگشت", "callback_data": "back_main"}])
     return {"inline_keyboard": rows}
 
+def kb_fp_select(la):
+    en = la == "en"
+    return {"inline_keyboard": [
+        [{"text": "📅 > 7d" if en else "📅 > ۷ روز", "callback_data": "fp_old_7"},
+         {"text": "📅 > 30d" if en else "📅 > ۳۰ روز", "callback_data": "fp_old_30"}],
+        [{"text": "📅 > 90d" if en else "📅 > ۹۰ روز", "callback_data": "fp_old_90"},
+         {"text": "📅 > 1y" if en else "📅 > ۱ سال", "callback_data": "fp_old_365"}],
+        [{"text": "📸 Media only" if en else "📸 فقط مدیا", "callback_data": "fp_media"}],
+        [{"text": "📂 Pick groups" if en else "📂 انتخاب گروه‌ها", "callback_data": "fp_pick"}],
+        [{"text": "🔙 Back" if en else "🔙 بازگشت", "callback_data": "back_main"}]]}
+
+def kb_fp_pick(la, groups, picked, page=0, per_page=8):
+    start = page * per_page
+    rows = [[{"text": f"{'✅' if g['id'] in picked else '▫️'} {g['title'][:22]} ({g['count']})",
+              "callback_data": f"fpk_{g['id']}"}] for g in groups[start:start + per_page]]
+    nav = []
+    if page > 0: nav.append({"text": "⬅️", "callback_data": f"fpkp_{page - 1}"})
+    if start + per_page < len(groups): nav.append({"text": "➡️", "callback_data": f"fpkp_{page + 1}"})
+    if nav: rows.append(nav)
+    go = f"🗑️ Delete selected ({len(picked)})" if la == "en" else f"🗑️ حذف انتخاب‌شده‌ها ({len(picked)})"
+    rows.append([{"text": go, "callback_data": "fp_pick_go"}])
+    rows.append([{"text": "🔙", "callback_data": "back_main"}])
+    return {"inline_keyboard": rows}
+
+def kb_autoclean(la):
+    en = la == "en"
+    return {"inline_keyboard": [
+        [{"text": "🔁 > 30d" if en else "🔁 > ۳۰ روز", "callback_data": "fp_auto_30"},
+         {"text": "🔁 > 90d" if en else "🔁 > ۹۰ روز", "callback_data": "fp_auto_90"}],
+        [{"text": "⏹ Off" if en else "⏹ خاموش", "callback_data": "fp_auto_off"}],
+        [{"text": "🔙 Back" if en else "🔙 بازگشت", "callback_data": "back_main"}]]}
+
+def kb_confirm_sel(la):
+    if la == "en":
+        return {"inline_keyboard": [[{"text": "✅ Yes delete", "callback_data": "fp_go"},
+                                     {"text": "❌ Cancel", "callback_data": "back_main"}],
+                                    [{"text": "📦 Backup first", "callback_data": "fp_export"}]]}
+    return {"inline_keyboard": [[{"text": "✅ بله حذف کن", "callback_data": "fp_go"},
+                                 {"text": "❌ انصراف", "callback_data": "back_main"}],
+                                [{"text": "📦 اول بکاپ بگیر", "callback_data": "fp_export"}]]}
+
+def kb_job_cancel(la):
+    return {"inline_keyboard": [[{"text": "⏹ لغو" if la == "fa" else "⏹ Cancel", "callback_data": "job_cancel"}]]}
+
 def kb_confirm(la):
     if la == "en":
         return {"inline_keyboard": [[
             {"text": "✅ Yes DELETE ALL", "callback_data": "fp_yes"},
-            {"text": "❌ Cancel", "callback_data": "back_main"}]]}
+            {"text": "❌ Cancel", "callback_data": "back_main"}],
+            [{"text": "✅ + 💬 private chats (both sides)", "callback_data": "fp_yes_pm"}],
+            [{"text": "📦 Backup first", "callback_data": "fp_export"}]]}
     return {"inline_keyboard": [[
         {"text": "✅ بله حذف کن", "callback_data": "fp_yes"},
-        {"text": "❌ انصراف", "callback_data": "back_main"}]]}
+        {"text": "❌ انصراف", "callback_data": "back_main"}],
+        [{"text": "✅ + 💬 چت‌های خصوصی (دوطرفه)", "callback_data": "fp_yes_pm"}],
+        [{"text": "📦 اول بکاپ بگیر", "callback_data": "fp_export"}]]}
 
 # ══════════════════════════════
 # TEXTS
@@ -213,13 +720,17 @@ T = {
     "stalk_not_found": "❌ کاربر یافت نشد یا پیامی در گروه‌های عمومی ندارد.\n\nمطمئن شوید یوزرنیم درسته.",
     "no_msgs": "💬 پیامی یافت نشد.",
     "footprint_info": "🧹 <b>ردپای دیجیتال من</b>\n\n📂 گروه‌ها: <b>{gr}</b>\n💬 پیام‌ها: <b>{msgs}</b>\n📸 مدیا: <b>{md}</b>\n📝 متن: <b>{tx}</b>",
+    "footprint_unknown": "⚠️ {n} گروه شمرده نشد؛ حذف همه، اون‌ها رو هم بررسی می‌کنه.",
+    "footprint_cached": "🕒 آخرین اسکن {ago} دقیقه پیش — در حال بروزرسانی...",
     "footprint_need_login": "🧹 <b>ردپای من</b>\n\nبرای <b>اسکن</b> نیاز به لاگین دارید تا بتونم پیام‌هاتونو پیدا کنم.\n\n📱 ورود بزنید.",
-    "footprint_confirm": "⚠️ <b>هشدار!</b>\n\n🗑️ <b>{msgs}</b> پیام از <b>{gr}</b> گروه حذف میشه!\n\n<b>برگشت‌ناپذیره!</b> مطمئنید؟",
-    "footprint_done": "✅ <b>پاکسازی کامل!</b>\n\n🗑️ حذف: <b>{done}</b>\n📂 گروه: {gr}\n⏱️ {time}\n❌ خطا: {err}",
+    "footprint_confirm": "⚠️ <b>هشدار!</b>\n\n🗑️ <b>{msgs}</b> پیام از <b>{gr}</b> گروه حذف میشه!\n💬 گزینه‌ی «چت‌های خصوصی» کل تاریخچه‌ی چت‌های خصوصی رو برای هر دو طرف پاک می‌کنه.\n\n<b>برگشت‌ناپذیره!</b> مطمئنید؟",
+    "footprint_done": "✅ <b>پاکسازی کامل!</b>\n\n🗑️ حذف: <b>{done}</b>\n📂 گروه: {gr}\n⏱️ {time}\n⚡ {rate} پیام/ثانیه\n❌ خطا: {err}",
+    "footprint_unlisted": "⚠️ پیام‌های {n} گروه کامل خونده نشد، دوباره پاکسازی کنید: {names}",
     "phone_ask": "📱 شماره با کد کشور:\n<code>+989121234567</code>\n\n🔐 AES-256 | ⏰ حذف ۲۴ ساعته",
     "code_ask": "📨 کد تأیید:", "2fa_ask": "🔐 رمز دوم:",
     "login_ok": "✅ ورود موفق!", "login_fail": "❌ خطا: {e}",
     "logout_ok": "✅ خارج شدید.", "not_logged": "❌ ابتدا 📱 ورود بزنید",
+    "session_expired": "⚠️ نشست تلگرام شما منقضی شده. دوباره 📱 ورود بزنید.",
     "profile": "👤 <b>پروفایل</b>\n\n🆔 <code>{uid}</code>\n👤 {name}\n💎 اعتبار: <b>{cr}</b>\n📊 استفاده: {used}\n🔐 {login}\n📅 {date}",
     "processing": "⏳ صبر کنید...", "error": "❌ خطا: {e}",
     "banned": "🚫 مسدود شدید.",
@@ -234,7 +745,25 @@ T = {
     "a_notfound": "❌ یافت نشد!",
     "a_lookup_ask": "🔎 آیدی:",
     "a_user_info": "📊 <code>{uid}</code>\n{name} | @{uname}\n💎{cr} | 📊{used} | {ban}\n📅 {date}",
-    "a_bcast_ask": "📢 متن:", "a_bcast_ok": "✅ ارسال به {n} نفر.",
+    "a_bcast_ask": "📢 متن:", "a_bcast_done": "📢 <b>ارسال تمام شد</b>\n\n✅ رسید: <b>{ok}</b>\n❌ خطا: {fail}\n🚫 بلاک: {blocked}\n⚡ {rate} پیام/ثانیه\n⏱️ {time}",
+    "fp_sel_ask": "🎯 <b>حذف انتخابی</b>\n\nکدوم پیام‌ها پاک بشن؟",
+    "fp_pick_ask": "📂 گروه‌ها رو انتخاب کنید:",
+    "fp_need_scan": "📊 اول «اسکن پیام‌های من» رو بزنید.",
+    "footprint_confirm_sel": "⚠️ <b>حذف انتخابی</b>\n\n🗑️ {what}\n\n<b>برگشت‌ناپذیره!</b> مطمئنید؟",
+    "auto_menu": "🔁 <b>پاکسازی خودکار</b>\n\nهر {every} ساعت پیام‌های قدیمی‌تر از N روز شما پاک میشه (هر اجرا ۱ اعتبار).\n\nوضعیت: {st}",
+    "auto_on": "✅ پاکسازی خودکار فعال: قدیمی‌تر از {days} روز\n⏰ اجرای بعدی: {next}\n\n"
+               "⚠️ فقط وقتی اجرا میشه که وارد شده باشید؛ ورود بعد از ۲۴ ساعت منقضی میشه و "
+               "تا ورود بعدی پاکسازی خودکار متوقف می‌مونه.",
+    "auto_paused": "⏸ پاکسازی خودکار متوقف شد: نشست شما منقضی شده. با 📱 ورود دوباره خودکار ادامه پیدا می‌کنه.",
+    "auto_off": "⏹ پاکسازی خودکار خاموش شد.",
+    "auto_no_credit": "🔁 پاکسازی خودکار اجرا نشد: اعتبار تمام شده.",
+    "export_part": "📦 بکاپ پیام‌های شما — بخش {n}",
+    "export_done": "📦 <b>بکاپ کامل شد</b>\n\n💬 پیام: <b>{msgs}</b>\n📂 چت: {gr}\n🗂 فایل: {parts}\n⏱️ {time}\n❌ خطا: {err}",
+    "job_queued": "⏳ سرور مشغوله، شما نفر <b>{pos}</b> در صف هستید.",
+    "job_busy_self": "⏳ یک کار در حال اجرا دارید. صبر کنید یا /cancel بزنید.",
+    "job_shed": "🚦 سرور خیلی شلوغه، چند دقیقه دیگه امتحان کنید.",
+    "job_cancelled": "⏹ کار لغو شد.", "job_none": "ℹ️ کاری در جریان نیست.",
+    "job_resumed": "♻️ ادامه‌ی پاکسازی قبلی شما...",
   },
   "en": {
     "welcome": "🌑 <b>ShadowClean</b>\n\n👁 <b>Stalk</b> - Find user msgs in public groups\n🧹 <b>Footprint</b> - View/delete my msgs\n\n💎 Credits: <b>{cr}</b>\n\n⚠️ Personal use only",
@@ -246,10 +775,14 @@ T = {
     "stalk_not_found": "❌ User not found or no public messages.\nCheck username.",
     "no_msgs": "💬 No messages.", "footprint_need_login": "🧹 Login to scan your msgs.",
     "footprint_info": "🧹 📂{gr} 💬{msgs} 📸{md} 📝{tx}",
-    "footprint_confirm": "⚠️ Delete {msgs} msgs from {gr} groups?\nIrreversible!",
-    "footprint_done": "✅ Deleted:{done} Groups:{gr} Time:{time} Err:{err}",
+    "footprint_unknown": "⚠️ {n} groups could not be counted; delete all still checks them.",
+    "footprint_cached": "🕒 Last scan {ago} min ago, refreshing...",
+    "footprint_confirm": "⚠️ Delete {msgs} msgs from {gr} groups?\n💬 \"private chats\" also wipes whole private chat histories for both sides.\nIrreversible!",
+    "footprint_done": "✅ Deleted:{done} Groups:{gr} Time:{time} Speed:{rate}/s Err:{err}",
+    "footprint_unlisted": "⚠️ {n} groups could not be fully listed, run the cleanup again: {names}",
     "phone_ask": "📱 <code>+989121234567</code>", "code_ask": "📨 Code:", "2fa_ask": "🔐 2FA:",
     "login_ok": "✅ OK!", "login_fail": "❌ {e}", "logout_ok": "✅ Out.",
+    "session_expired": "⚠️ Telegram session expired, please login again.",
     "not_logged": "❌ Login first", "profile": "👤 {uid}|{name}|💎{cr}|📊{used}|{login}|{date}",
     "processing": "⏳...", "error": "❌ {e}", "banned": "🚫 Banned.",
     "no_credit": "❌ No credits!",
@@ -261,7 +794,25 @@ T = {
     "a_unban_ask": "✅ ID:", "a_unban_ok": "✅ {uid} unbanned.",
     "a_notfound": "❌ Not found!", "a_lookup_ask": "🔎 ID:",
     "a_user_info": "{uid}|{name}|@{uname}|💎{cr}|📊{used}|{ban}|{date}",
-    "a_bcast_ask": "📢 Text:", "a_bcast_ok": "✅ Sent {n}.",
+    "a_bcast_ask": "📢 Text:", "a_bcast_done": "📢 Delivered:{ok} Failed:{fail} Blocked:{blocked} Speed:{rate}/s Time:{time}",
+    "fp_sel_ask": "🎯 <b>Selective delete</b>\nWhich messages should go?",
+    "fp_pick_ask": "📂 Pick groups:",
+    "fp_need_scan": "📊 Run \"Scan My Messages\" first.",
+    "footprint_confirm_sel": "⚠️ Selective delete: {what}\nIrreversible!",
+    "auto_menu": "🔁 <b>Auto-clean</b>\nEvery {every}h, delete my messages older than N days (1 credit per run).\nStatus: {st}",
+    "auto_on": "✅ Auto-clean on: older than {days} days\n⏰ Next run: {next}\n\n"
+               "⚠️ It only runs while you are logged in. A login lasts 24h; after that auto-clean "
+               "pauses until you log in again.",
+    "auto_paused": "⏸ Auto-clean paused: your session expired. It resumes when you 📱 login again.",
+    "auto_off": "⏹ Auto-clean off.",
+    "auto_no_credit": "🔁 Auto-clean skipped: no credits left.",
+    "export_part": "📦 Your messages backup, part {n}",
+    "export_done": "📦 Backup done: {msgs} msgs from {gr} chats in {parts} file(s), {time}, Err:{err}",
+    "job_queued": "⏳ Busy, queued at position <b>{pos}</b>.",
+    "job_busy_self": "⏳ You already have a job running. Wait or /cancel.",
+    "job_shed": "🚦 Server overloaded, try again in a few minutes.",
+    "job_cancelled": "⏹ Job cancelled.", "job_none": "ℹ️ No active job.",
+    "job_resumed": "♻️ Resuming your previous cleanup...",
   }
 }
 
@@ -270,70 +821,205 @@ def tx(la, key, **kw):
     try: return txt.format(**kw) if kw else txt
     except: return txt
 
+def filt_text(la, f):
+    en = la == "en"; parts = []
+    if f.get("days"): parts.append(f"older than {f['days']} days" if en else f"قدیمی‌تر از {f['days']} روز")
+    if f.get("media"): parts.append("media only" if en else "فقط مدیا")
+    if f.get("groups"): parts.append(f"{len(f['groups'])} picked groups" if en else f"{len(f['groups'])} گروه انتخابی")
+    return ", ".join(parts)
+
 # ══════════════════════════════
 # DB HELPERS
 # ══════════════════════════════
+class UserCache:
+    """Detached UserDB rows by id for `ttl` seconds, least recently loaded dropped beyond `size`.
+
+    Anything that changes credits/ban/lang writes the DB and drops the entry.
+    username/first_name changes are only queued and written every USER_FLUSH
+    seconds in one transaction. With several workers another worker's copy can
+    be up to `ttl` old.
+    """
+    def __init__(self, ttl, size):
+        self.ttl, self.size = ttl, size
+        self.d: OrderedDict = OrderedDict()  # uid -> (expires, UserDB)
+        self.dirty: Dict[int, dict] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.hits = self.misses = self.flushed = 0
+
+    def start(self):
+        if not self.task: self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task: self.task.cancel(); self.task = None
+        await self.flush()
+
+    def stats(self):
+        return {"size": len(self.d), "hits": self.hits, "misses": self.misses,
+                "dirty": len(self.dirty), "flushed": self.flushed}
+
+    def get(self, uid):
+        e = self.d.get(uid)
+        if e and e[0] > time.monotonic(): self.hits += 1; return e[1]
+        if e: del self.d[uid]
+        self.misses += 1; return None
+
+    def put(self, u):
+        self.d.pop(u.id, None); self.d[u.id] = (time.monotonic() + self.ttl, u)
+        while len(self.d) > self.size: self.d.popitem(last=False)
+
+    def drop(self, uid): self.d.pop(uid, None)
+
+    def mark(self, uid, **fields): self.dirty.setdefault(uid, {}).update(fields)
+
+    async def flush(self):
+        if not self.dirty: return
+        batch, self.dirty = self.dirty, {}
+        try:
+            async with DBS() as db:
+                await db.execute(update(UserDB), [{"id": uid, **f} for uid, f in batch.items()])
+                await db.commit()
+            self.flushed += len(batch)
+        except Exception as e:
+            for uid, f in batch.items(): self.dirty[uid] = {**f, **self.dirty.get(uid, {})}
+            print(f"user flush error: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(USER_FLUSH)
+            await self.flush()
+
+user_cache = UserCache(USER_TTL, USER_CACHE_MAX)
+
+# Admin panel counters: one SQL recount every STATS_TTL, adjusted in place in between
+# by the paths that change them (new user, ban/unban, login/logout).
+stats_snap: Dict[str, float] = {}
+
+def stats_bump(k, n=1):
+    if stats_snap: stats_snap[k] += n
+
 async def get_user(db, uid, uname="", fname=""):
-    r = await db.execute(select(UserDB).where(UserDB.id == uid))
-    u = r.scalar_one_or_none()
+    u = user_cache.get(uid)
     if not u:
-        u = UserDB(id=uid, username=uname, first_name=fname, credits=DEFAULT_CREDITS, is_admin=uid in ADMIN_IDS)
-        db.add(u); await db.commit(); await db.refresh(u)
-    else:
-        ch = False
-        if uname and u.username != uname: u.username = uname; ch = True
-        if fname and u.first_name != fname: u.first_name = fname; ch = True
-        if uid in ADMIN_IDS and not u.is_admin: u.is_admin = True; ch = True
-        if ch: await db.commit()
+        r = await db.execute(select(UserDB).where(UserDB.id == uid))
+        u = r.scalar_one_or_none()
+        if not u:
+            u = UserDB(id=uid, username=uname, first_name=fname, credits=DEFAULT_CREDITS, is_admin=uid in ADMIN_IDS)
+            db.add(u); await db.commit(); await db.refresh(u); stats_bump("total")
+        elif (uid in ADMIN_IDS and not u.is_admin) or u.blocked:
+            u.is_admin = u.is_admin or uid in ADMIN_IDS; u.blocked = False; await db.commit()
+        db.expunge(u); user_cache.put(u)
+    # profile fields are written behind; the cached copy is updated right away
+    ch = {}
+    if uname and u.username != uname: ch["username"] = uname
+    if fname and u.first_name != fname: ch["first_name"] = fname
+    if ch:
+        for k, v in ch.items(): setattr(u, k, v)
+        user_cache.mark(uid, **ch)
     return u
 
 async def has_credit(u):
     return True if (u.is_admin or u.id in ADMIN_IDS) else u.credits > 0
 
-async def use_credit(db, uid):
-    r = await db.execute(select(UserDB).where(UserDB.id == uid))
-    u = r.scalar_one_or_none()
-    if not u: return False
-    if u.is_admin or u.id in ADMIN_IDS: u.total_used += 1; await db.commit(); return True
-    if u.credits <= 0: return False
-    u.credits -= 1; u.total_used += 1; await db.commit(); return True
+class CreditLedger:
+    """Buffers credit events and inserts them in one batch every CREDIT_FLUSH seconds."""
+    def __init__(self):
+        self.buf: List[dict] = []
+        self.task: Optional[asyncio.Task] = None
+        self.written = 0
+
+    def start(self):
+        if not self.task: self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task: self.task.cancel(); self.task = None
+        await self.flush()
+
+    def log(self, uid, delta, balance, reason):
+        self.buf.append({"user_id": uid, "delta": delta, "balance": balance, "reason": reason,
+                         "ts": datetime.now(timezone.utc)})
+
+    async def flush(self):
+        if not self.buf: return
+        batch, self.buf = self.buf, []
+        try:
+            async with DBS() as db:
+                await db.execute(pg_insert(CreditEventDB), batch); await db.commit()
+            self.written += len(batch)
+        except Exception as e:
+            self.buf[:0] = batch; print(f"ledger flush error: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(CREDIT_FLUSH)
+            await self.flush()
+
+ledger = CreditLedger()
+
+# Balances change in one conditional UPDATE ... RETURNING, never read-modify-write,
+# so concurrent charges can't overdraw. Admins are charged nothing but still counted.
+CREDIT_FREE = or_(UserDB.is_admin == True, UserDB.id.in_(ADMIN_IDS))
+
+async def _credit_update(db, uid, where, **values):
+    r = await db.execute(update(UserDB).where(and_(UserDB.id == uid, where)).values(**values)
+                         .returning(UserDB.credits, CREDIT_FREE.label("free"))
+                         .execution_options(synchronize_session=False))
+    row = r.first(); await db.commit(); user_cache.drop(uid)
+    return row
+
+async def use_credit(db, uid, reason="charge"):
+    row = await _credit_update(db, uid, or_(UserDB.credits > 0, CREDIT_FREE),
+                               credits=case((CREDIT_FREE, UserDB.credits), else_=UserDB.credits - 1),
+                               total_used=UserDB.total_used + 1)
+    if not row: return False
+    if not row.free: ledger.log(uid, -1, row.credits, reason)
+    return True
+
+async def refund_credit(db, uid, reason="refund"):
+    """Give back a use_credit() charge for a job that never did any work."""
+    row = await _credit_update(db, uid, True,
+                               credits=case((CREDIT_FREE, UserDB.credits), else_=UserDB.credits + 1),
+                               total_used=func.greatest(UserDB.total_used - 1, 0))
+    if row and not row.free: ledger.log(uid, 1, row.credits, reason)
 
 async def add_credits(db, uid, n):
-    r = await db.execute(select(UserDB).where(UserDB.id == uid))
-    u = r.scalar_one_or_none()
-    if not u: return None
-    u.credits += n; await db.commit(); return u.credits
+    row = await _credit_update(db, uid, True, credits=UserDB.credits + n)
+    if not row: return None
+    ledger.log(uid, n, row.credits, "add"); return row.credits
 
 async def set_credits(db, uid, n):
-    r = await db.execute(select(UserDB).where(UserDB.id == uid))
-    u = r.scalar_one_or_none()
-    if not u: return None
-    u.credits = n; await db.commit(); return u.credits
+    row = await _credit_update(db, uid, True, credits=n)
+    if not row: return None
+    ledger.log(uid, None, n, "set"); return row.credits
 
 async def ban_user(db, uid):
     r = await db.execute(select(UserDB).where(UserDB.id == uid))
     u = r.scalar_one_or_none()
     if not u: return False
-    u.is_banned = True; await db.commit(); return True
+    if not u.is_banned: stats_bump("banned")
+    u.is_banned = True; await db.commit(); user_cache.drop(uid); return True
 
 async def unban_user(db, uid):
     r = await db.execute(select(UserDB).where(UserDB.id == uid))
     u = r.scalar_one_or_none()
     if not u: return False
-    u.is_banned = False; await db.commit(); return True
+    if u.is_banned: stats_bump("banned", -1)
+    u.is_banned = False; await db.commit(); user_cache.drop(uid); return True
+
+async def set_lang(db, uid, la):
+    await db.execute(update(UserDB).where(UserDB.id == uid).values(lang=la)); await db.commit()
+    user_cache.drop(uid)
 
 async def lookup_user(db, uid):
     r = await db.execute(select(UserDB).where(UserDB.id == uid))
     return r.scalar_one_or_none()
 
-async def get_all_users(db):
-    r = await db.execute(select(UserDB)); return r.scalars().all()
-
 async def get_stats(db):
-    users = await get_all_users(db)
-    total = len(users); banned = sum(1 for u in users if u.is_banned)
-    r2 = await db.execute(select(SessionDB).where(SessionDB.authorized == True))
-    logged = len(r2.scalars().all()); return total, banned, logged
+    if not stats_snap or time.monotonic() - stats_snap["at"] > STATS_TTL:
+        logged = select(func.count(SessionDB.id)).where(SessionDB.authorized == True).scalar_subquery()
+        r = await db.execute(select(func.count(UserDB.id), func.count(UserDB.id).filter(UserDB.is_banned == True), logged))
+        total, banned, logged = r.one()
+        stats_snap.update(total=total, banned=banned, logged=logged, at=time.monotonic())
+    return int(stats_snap["total"]), int(stats_snap["banned"]), int(stats_snap["logged"])
 
 async def get_auth_session(db, uid):
     r = await db.execute(select(SessionDB).where(and_(
@@ -346,7 +1032,8 @@ async def get_any_sess(db, uid):
     return r.scalar_one_or_none()
 
 async def save_sess(db, uid, phone, ss, ph):
-    await db.execute(delete(SessionDB).where(SessionDB.user_id == uid))
+    r = await db.execute(delete(SessionDB).where(SessionDB.user_id == uid).returning(SessionDB.authorized))
+    stats_bump("logged", -sum(1 for a in r.scalars() if a))
     s = SessionDB(user_id=uid, phone=phone, enc_session=fernet.encrypt(ss.encode()).decode(),
                    phone_hash=ph, expires=datetime.now(timezone.utc) + timedelta(hours=24))
     db.add(s); await db.commit()
@@ -354,30 +1041,265 @@ async def save_sess(db, uid, phone, ss, ph):
 async def auth_sess(db, uid, ss):
     r = await db.execute(select(SessionDB).where(SessionDB.user_id == uid))
     s = r.scalar_one_or_none()
-    if s: s.enc_session = fernet.encrypt(ss.encode()).decode(); s.authorized = True; await db.commit()
+    if not s: return
+    if not s.authorized: stats_bump("logged")
+    s.enc_session = fernet.encrypt(ss.encode()).decode(); s.authorized = True
+    # a paused auto-clean runs at the next tick
+    await db.execute(update(AutoCleanDB).where(and_(AutoCleanDB.user_id == uid, AutoCleanDB.paused == True))
+                     .values(paused=False, next_run=datetime.now(timezone.utc)))
+    await db.commit()
 
 async def del_sess(db, uid):
-    await db.execute(delete(SessionDB).where(SessionDB.user_id == uid)); await db.commit()
+    r = await db.execute(delete(SessionDB).where(SessionDB.user_id == uid).returning(SessionDB.authorized))
+    stats_bump("logged", -sum(1 for a in r.scalars() if a)); await db.commit()
+
+async def create_job(db, uid, cid, kind, la, params=None):
+    j = JobDB(user_id=uid, chat_id=cid, kind=kind, lang=la, params=json.dumps(params or {}))
+    db.add(j); await db.commit(); return j.id
+
+async def finish_job(db, job_id, status, done=0, err=0):
+    j = await db.get(JobDB, job_id)
+    if j: j.status = status; j.done = done; j.err = err; j.updated = datetime.now(timezone.utc); await db.commit()
+
+async def save_job(db, job_id, params, done, err):
+    j = await db.get(JobDB, job_id)
+    if j:
+        j.params = json.dumps(params); j.done = done; j.err = err; j.updated = datetime.now(timezone.utc)
+        await db.commit()
+
+async def cancel_user_jobs(db, uid):
+    r = await db.execute(select(JobDB).where(and_(JobDB.user_id == uid, JobDB.status == "running")))
+    for j in r.scalars().all(): j.status = "cancelled"; j.updated = datetime.now(timezone.utc)
+    await db.commit()
+
+async def get_resumable_jobs(db):
+    r = await db.execute(select(JobDB).where(and_(JobDB.status == "running", owned(JobDB.user_id),
+                                                  JobDB.kind.in_(("delete", "autoclean", "broadcast")))))
+    return r.scalars().all()
+
+async def get_ckpts(db, job_id):
+    r = await db.execute(select(JobGroupDB).where(JobGroupDB.job_id == job_id))
+    return {c.group_id: c for c in r.scalars().all()}
+
+async def save_ckpt(db, job_id, gid, title, last_id, done, err, status="running", stage=0):
+    vals = dict(title=title, last_msg_id=last_id, stage=stage, done=done, err=err, status=status)
+    q = pg_insert(JobGroupDB).values(job_id=job_id, group_id=gid, **vals)
+    await db.execute(q.on_conflict_do_update(index_elements=["job_id", "group_id"], set_=vals))
+    await db.commit()
+
+def auto_next(hours, first=False):
+    """Next run time with jitter; the first run lands anywhere in the first interval."""
+    sec = hours * 3600
+    d = random.uniform(0, sec) if first else sec * (1 + random.uniform(-AUTO_JITTER, AUTO_JITTER))
+    return datetime.now(timezone.utc) + timedelta(seconds=d)
+
+async def set_autoclean(db, uid, cid, la, days):
+    ac = await db.get(AutoCleanDB, uid)
+    if not ac: ac = AutoCleanDB(user_id=uid, marks="{}"); db.add(ac)
+    ac.chat_id = cid; ac.lang = la; ac.days = days; ac.enabled = True; ac.paused = False
+    ac.every_hours = AUTO_EVERY_HOURS; ac.next_run = auto_next(AUTO_EVERY_HOURS, first=True)
+    await db.commit(); return ac
+
+async def disable_autoclean(db, uid):
+    ac = await db.get(AutoCleanDB, uid)
+    if ac: ac.enabled = False; await db.commit()
+
+async def due_autocleans(db, limit):
+    r = await db.execute(select(AutoCleanDB).where(and_(AutoCleanDB.enabled == True, AutoCleanDB.paused == False,
+        owned(AutoCleanDB.user_id), AutoCleanDB.next_run <= datetime.now(timezone.utc))).order_by(AutoCleanDB.next_run).limit(limit))
+    return r.scalars().all()
+
+async def get_scan(db, uid):
+    r = await db.execute(select(ScanDB).where(ScanDB.user_id == uid))
+    return {c.group_id: c for c in r.scalars().all()}
+
+async def save_scan(db, uid, groups, empty=()):
+    now = datetime.now(timezone.utc)
+    if groups:
+        q = pg_insert(ScanDB).values([dict(user_id=uid, group_id=g["id"], title=g["title"][:255], count=g["count"],
+            media=g["media"], text=g["text"], max_id=g["max_id"], updated=now) for g in groups])
+        await db.execute(q.on_conflict_do_update(index_elements=["user_id", "group_id"],
+            set_={k: q.excluded[k] for k in ("title", "count", "media", "text", "max_id", "updated")}))
+    if empty: await db.execute(delete(ScanDB).where(and_(ScanDB.user_id == uid, ScanDB.group_id.in_(list(empty)))))
+    await db.commit()
 
 async def dec_sess(db, uid):
     s = await get_auth_session(db, uid)
     if s and s.enc_session: return fernet.decrypt(s.enc_session.encode()).decode()
     return None
 
+# StringSession only carries the auth key; the entity cache (id, access hash,
+# username, phone, name rows) is kept next to it so reconnects start warm.
+async def load_entities(uid):
+    async with DBS() as db:
+        s = await get_auth_session(db, uid)
+        if not s or not s.entities: return []
+        try: return json.loads(zlib.decompress(fernet.decrypt(s.entities.encode())))
+        except Exception: return []
+
+async def save_entities(uid, rows):
+    rows = list({r[0]: r for r in rows}.values())[:ENT_CACHE_MAX]
+    blob = fernet.encrypt(zlib.compress(json.dumps(rows, separators=(",", ":")).encode())).decode()
+    async with DBS() as db:
+        await db.execute(update(SessionDB).where(and_(SessionDB.user_id == uid, SessionDB.authorized == True))
+                         .values(entities=blob))
+        await db.commit()
+
 # ══════════════════════════════
 # TELETHON (user sessions)
 # ══════════════════════════════
-user_clients: Dict[int, TelegramClient] = {}
+class SessionExpired(Exception):
+    """The stored session was revoked or logged out from another device."""
+
+class ClientPool:
+    """Connected user clients, at most `size` of them, least recently used evicted first.
+
+    A reaper disconnects clients idle for `idle` seconds. Clients of users with a
+    queued/running job (`pinned`) are never evicted or reaped. A client's entity
+    cache is restored on connect and saved back when it leaves the pool.
+    """
+    def __init__(self, size, idle, pinned=lambda uid: False):
+        self.size, self.idle, self.pinned = size, idle, pinned
+        self.lru: OrderedDict = OrderedDict()  # uid -> [client, last_used, entities at load/save]
+        self.connecting: Dict[int, asyncio.Task] = {}
+        self.reaper: Optional[asyncio.Task] = None
+        self.hits = self.misses = self.evicted = self.reaped = 0
+
+    def start(self):
+        if not self.reaper: self.reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        if self.reaper: self.reaper.cancel(); self.reaper = None
+        for uid in list(self.lru): await self.drop(uid)
+
+    def stats(self):
+        return {"size": len(self.lru), "max": self.size, "hits": self.hits, "misses": self.misses,
+                "evicted": self.evicted, "idle_closed": self.reaped}
+
+    async def get(self, uid, ss):
+        e = self.lru.get(uid)
+        if e and e[0].is_connected():
+            self.hits += 1; e[1] = time.monotonic(); self.lru.move_to_end(uid)
+            return e[0]
+        # one connect per user; concurrent callers wait for it
+        t = self.connecting.get(uid)
+        if not t:
+            self.misses += 1
+            t = self.connecting[uid] = asyncio.create_task(self._open(uid, ss))
+            t.add_done_callback(lambda _: self.connecting.pop(uid, None))
+        return await asyncio.shield(t)
+
+    async def drop(self, uid, save=True):
+        """Disconnect; save=False when the session itself is going away (logout, expiry)."""
+        e = self.lru.pop(uid, None)
+        if not e: return
+        ents = getattr(e[0].session, "_entities", None)
+        if save and ents and len(ents) != e[2]:
+            try: await save_entities(uid, ents)
+            except Exception as ex: print(f"save_entities error: {ex}")
+        await self._close(e[0])
+
+    async def _open(self, uid, ss):
+        await self.drop(uid)  # stale, disconnected entry
+        c = TelegramClient(StringSession(ss), API_ID, API_HASH)
+        try: c.session._entities |= {tuple(r) for r in await load_entities(uid)}
+        except Exception as ex: print(f"load_entities error: {ex}")
+        await c.connect()
+        if not await c.is_user_authorized():
+            await self._close(c); raise SessionExpired()
+        await self._add(uid, c); return c
+
+    async def adopt(self, uid, c):
+        """Take over a client that is already connected and signed in (a finished login)."""
+        await self.drop(uid); await self._add(uid, c, 0)
+
+    async def _add(self, uid, c, known=None):
+        n = len(getattr(c.session, "_entities", ())) if known is None else known
+        self.lru[uid] = [c, time.monotonic(), n]
+        over = len(self.lru) - self.size
+        if over > 0:
+            for old in [u for u in self.lru if u != uid and not self.pinned(u)][:over]:
+                await self.drop(old); self.evicted += 1
+
+    @staticmethod
+    async def _close(c):
+        try: await c.disconnect()
+        except Exception: pass
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(POOL_REAP)
+            cut = time.monotonic() - self.idle
+            for uid in [u for u, e in self.lru.items() if e[1] < cut and not self.pinned(u)]:
+                await self.drop(uid); self.reaped += 1
+
+clients = ClientPool(POOL_MAX, POOL_IDLE, lambda uid: jobs.busy(uid))
 
 async def get_user_client(uid, ss):
-    if uid in user_clients and user_clients[uid].is_connected(): return user_clients[uid]
-    c = TelegramClient(StringSession(ss), API_ID, API_HASH)
-    await c.connect(); user_clients[uid] = c; return c
+    try: return await clients.get(uid, ss)
+    except SessionExpired:
+        await expire_session(uid); raise
+
+async def job_client(uid, ss, cid, la):
+    """get_user_client() for a job: failing to connect ends it before any work (refunded)."""
+    try: return await get_user_client(uid, ss)
+    except (OSError, asyncio.TimeoutError) as e:
+        await send(cid, tx(la, "error", e=str(e)[:200] or type(e).__name__)); raise JobSkipped() from e
+
+async def expire_session(uid):
+    """Forget a dead session: pooled client, cached dialogs and the stored session."""
+    await clients.drop(uid, save=False); dialog_cache.pop(uid, None)
+    async with DBS() as db: await del_sess(db, uid)
 
 async def new_user_client():
     c = TelegramClient(StringSession(), API_ID, API_HASH)
     await c.connect(); return c
 
+class PendingLogins:
+    """Connected clients of logins in progress (phone -> code -> 2FA), keyed by user id.
+
+    Every step reuses the same connection. An entry is disconnected `ttl` seconds
+    after its last step, or handed to the client pool once signed in.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.items: Dict[int, tuple] = {}  # uid -> (client, expiry timer)
+
+    def get(self, uid):
+        e = self.items.get(uid)
+        if not e or not e[0].is_connected(): return None
+        self.put(uid, e[0]); return e[0]  # restarts the timer
+
+    def put(self, uid, c):
+        old = self.items.pop(uid, None)
+        if old:
+            old[1].cancel()
+            if old[0] is not c: spawn(ClientPool._close(old[0]))
+        h = asyncio.get_running_loop().call_later(self.ttl, lambda: spawn(self.drop(uid, c)))
+        self.items[uid] = (c, h)
+
+    def pop(self, uid):
+        e = self.items.pop(uid, None)
+        if e: e[1].cancel(); return e[0]
+        return None
+
+    async def drop(self, uid, c=None):
+        e = self.items.get(uid)
+        if e and (c is None or e[0] is c):
+            del self.items[uid]; e[1].cancel(); await ClientPool._close(e[0])
+
+    async def stop(self):
+        for uid in list(self.items): await self.drop(uid)
+
+logins = PendingLogins(LOGIN_TTL)
+
+async def login_client(uid, so):
+    """The pending login's client, or one rebuilt from the stored session (e.g. after a restart)."""
+    c = logins.get(uid)
+    if c: return c
+    c = TelegramClient(StringSession(fernet.decrypt(so.enc_session.encode()).decode()), API_ID, API_HASH)
+    await c.connect(); logins.put(uid, c); return c
+
 # ══════════════════════════════
 # MESSAGE LINK BUILDER
 # ══════════════════════════════
@@ -424,7 +1346,7 @@ async def stalk_search(client, target_id, cid, la):
     try:
         dialogs = await client.get_dialogs(limit=500)
         
-        pm = await send(cid, tx(la, "stalk_searching"))
+        pm = await send(cid, tx(la, "stalk_searching"), kb_job_cancel(la))
         pmid = pm.get("result", {}).get("message_id")
         
         searchable = []
@@ -457,9 +1379,7 @@ async def stalk_search(client, target_id, cid, la):
             # Update progress
             if pmid and (i + 1) % 10 == 0:
                 pct = int((i + 1) / max(len(searchable), 1) * 100)
-                try:
-                    await edit(cid, pmid, f"🔍 {pct}% | {len(found)} groups found | {total_msgs} msgs")
-                except: pass
+                progress(cid, pmid, f"🔍 {pct}% | {len(found)} groups found | {total_msgs} msgs", kb_job_cancel(la))
         
         # Clean up progress message
         if pmid:
@@ -507,87 +1427,553 @@ async def get_msgs_in_group(client, target_id, group_id, limit=30):
 # ══════════════════════════════
 # FOOTPRINT ENGINE (my own msgs)
 # ══════════════════════════════
-async def my_footprint_scan(client, cid, la):
-    """Scan my own messages using user client."""
-    res = {"groups": [], "total": 0, "media": 0, "text": 0}
-    try:
-        me = await client.get_me()
-        dialogs = await client.get_dialogs(limit=500)
-        groups = [d for d in dialogs if isinstance(d.entity, Channel) and getattr(d.entity, 'megagroup', False)]
-        
-        pm = await send(cid, tx(la, "processing"))
-        pmid = pm.get("result", {}).get("message_id")
-        
-        for i, d in enumerate(groups):
-            gc = gm = gt = 0
+class FloodGate:
+    """Request pacing shared by every task of one Telegram account.
+
+    A token bucket: up to FP_BURST requests start at once, FP_RATE per second after
+    that, so concurrent tasks overlap their latency. A FloodWait seen by any task
+    pauses all of them for the requested time, empties the bucket and halves the
+    rate; successful calls grow it back.
+    """
+    def __init__(self):
+        self.bucket = TokenBucket(FP_RATE, FP_BURST); self.floods = 0
+
+    async def wait(self): await self.bucket.take()
+
+    def ok(self): self.bucket.rate = min(FP_RATE, self.bucket.rate * 1.1)
+
+    def flood(self, sec):
+        b = self.bucket; self.floods += 1
+        b.pause(sec + 1); b.rate = max(FP_MIN_RATE, b.rate / 2)
+        b.tokens, b.ts = 0.0, b.paused_until  # no burst right after the pause
+
+    async def call(self, fn, *a, **kw):
+        for i in range(FP_FLOOD_RETRIES + 1):
+            await self.wait()
             try:
-                async for m in client.iter_messages(d.entity, from_user=me.id):
-                    gc += 1
-                    if m.media: gm += 1
-                    else: gt += 1
-                if gc:
-                    res["groups"].append({
-                        "id": d.entity.id, "title": d.entity.title,
-                        "count": gc, "media": gm, "text": gt
-                    })
-                    res["total"] += gc; res["media"] += gm; res["text"] += gt
+                r = await fn(*a, **kw); self.ok(); return r
             except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 1)
-            except: continue
-            
-            if pmid and (i + 1) % 3 == 0:
-                pct = int((i + 1) / max(len(groups), 1) * 100)
-                try: await edit(cid, pmid, f"📊 {pct}%...")
-                except: pass
-    except: pass
-    return res
+                self.flood(e.seconds)
+                if i == FP_FLOOD_RETRIES: raise
+
+flood_gates: Dict[int, FloodGate] = {}
+
+def flood_gate(uid):
+    if uid not in flood_gates: flood_gates[uid] = FloodGate()
+    return flood_gates[uid]
+
+dialog_cache: Dict[int, tuple] = {}
+
+def sweep_fp():
+    """Drop expired dialog lists and the flood gates of accounts idle for FP_DIALOG_TTL
+    (not mid-pause, no job), so neither dict grows with every user who ever scanned."""
+    now = time.monotonic()
+    for uid in [u for u, (ts, *_) in dialog_cache.items() if now - ts >= FP_DIALOG_TTL]: del dialog_cache[uid]
+    for uid in [u for u, g in flood_gates.items() if now - g.bucket.ts >= FP_DIALOG_TTL
+                and g.bucket.paused_until <= now and not jobs.busy(u)]:
+        del flood_gates[uid]
+
+SERVICE_USER_ID = 777000  # Telegram service notifications
+
+def fp_kind(ent):
+    """mega = supergroup, chat = basic group, pm = one-to-one chat; None = not covered."""
+    if isinstance(ent, Channel): return "mega" if getattr(ent, 'megagroup', False) else None
+    if isinstance(ent, Chat): return None if (ent.deactivated or ent.left) else "chat"
+    if isinstance(ent, User): return None if (ent.is_self or ent.id == SERVICE_USER_ID) else "pm"
+    return None
 
-async def my_footprint_delete(client, cid, la):
-    """Delete all my messages from supergroups."""
-    res = {"done": 0, "err": 0, "gr": 0, "det": []}
+def fp_title(ent):
+    t = getattr(ent, 'title', None)
+    if t: return t
+    name = f'{getattr(ent, "first_name", "") or ""} {getattr(ent, "last_name", "") or ""}'.strip()
+    return name or getattr(ent, 'username', None) or str(ent.id)
+
+async def fp_groups(client, uid=None, private=False):
+    """Stream the account's groups (super + basic) from every dialog, archived folder
+    included; with private=True one-to-one chats too.
+
+    Chats are yielded while dialogs are still being paged; a complete listing
+    is cached per user for FP_DIALOG_TTL (shared by scan and delete). Only what
+    was asked for is kept: a group-only listing caches no private chats, and a
+    later private=True call lists the dialogs again.
+    """
+    hit = dialog_cache.get(uid) if uid else None
+    if hit and time.monotonic() - hit[0] < FP_DIALOG_TTL and (hit[2] or not private):
+        for e in hit[1]:
+            if private or fp_kind(e) != "pm": yield e
+        return
+    chats, ids = [], set()
+    async for d in client.iter_dialogs():  # no limit, folder=None: all folders
+        e = d.entity; k = fp_kind(e)
+        if k and e.id not in ids and (private or k != "pm"):
+            ids.add(e.id); chats.append(e); yield e
+    if uid: dialog_cache[uid] = (time.monotonic(), chats, private)
+
+async def fan_out(source, fn, n, counter=None):
+    """Run fn(item) for every item of an async iterator, at most n at a time,
+    starting as soon as the first item arrives. counter["seen"]/["listing"] track the source."""
+    counter = counter if counter is not None else {}
+    counter["seen"] = 0; counter["listing"] = True
+    q: asyncio.Queue = asyncio.Queue(maxsize=n)
+
+    async def worker():
+        while (item := await q.get()) is not None:
+            try: await fn(item)
+            except Exception as e: print(f"fan_out error: {e}\n{traceback.format_exc()}")
+
+    ws = [asyncio.create_task(worker()) for _ in range(n)]
     try:
-        me = await client.get_me()
-        dialogs = await client.get_dialogs(limit=500)
-        groups = [d for d in dialogs if isinstance(d.entity, Channel) and getattr(d.entity, 'megagroup', False)]
-        
-        pm = await send(cid, tx(la, "processing"))
+        async for item in source:
+            counter["seen"] += 1; await q.put(item)
+        counter["listing"] = False
+        for _ in ws: await q.put(None)
+        await asyncio.gather(*ws)
+    finally:
+        for w in ws: w.cancel()
+
+async def fp_count(client, ent, me_id, gate, prev=None):
+    """Totals from search result counts. One request (limit=1 also gives the newest id);
+    the media filters are only queried when the group changed since `prev`."""
+    r = await gate.call(client.get_messages, ent, limit=1, from_user=me_id)
+    total = r.total or 0; top = r[0].id if r else 0
+    if not total: return 0, 0, 0, 0, None
+    if prev and prev.max_id == top and prev.count == total: return total, prev.media, prev.text, top, None
+    media = 0
+    for f in FP_MEDIA_FILTERS:
+        media += (await gate.call(client.get_messages, ent, limit=0, from_user=me_id, filter=f)).total or 0
+    media = min(media, total)
+    return total, media, total - media, top, None
+
+async def fp_iter_count(client, ent, me_id, prev=None):
+    """Full iteration with an exact media/text split. Given `prev`, only messages
+    above its max_id are fetched and merged into its totals, unless the search total
+    shows messages were removed since (then the group is recounted from scratch).
+    The ids are kept for the delete handoff when the whole group was read and has
+    <= FP_HANDOFF_IDS."""
+    if prev:
+        total = (await client.get_messages(ent, limit=0, from_user=me_id)).total or 0
+        if not total: return 0, 0, 0, 0, None
+        if total < prev.count: prev = None
+    gc = gm = gt = 0; top = prev.max_id if prev else 0
+    ids = [] if not prev else None
+    async for m in client.iter_messages(ent, from_user=me_id, min_id=top):
+        top = max(top, m.id); gc += 1
+        if m.media: gm += 1
+        else: gt += 1
+        if ids is not None:
+            ids.append(m.id)
+            if len(ids) > FP_HANDOFF_IDS: ids = None
+    if prev:
+        if prev.count + gc != total: return await fp_iter_count(client, ent, me_id)  # cache out of step
+        gc += prev.count; gm += prev.media; gt += prev.text
+    return gc, gm, gt, top, ids
+
+async def fp_me(client, cid, la, uid):
+    """The account's own user, first request of every footprint job. A dead connection
+    is JobSkipped (refunded); a logged-out session is SessionExpired."""
+    try: me = await client.get_me()
+    except (OSError, asyncio.TimeoutError) as e:
+        await send(cid, tx(la, "error", e=str(e)[:200] or type(e).__name__)); raise JobSkipped() from e
+    except UnauthorizedError: me = None
+    if me is None:
+        await expire_session(uid); raise SessionExpired()
+    return me
+
+async def my_footprint_scan(client, cid, la, full=False, gate=None, cache=None, uid=None):
+    """Scan my own messages, FP_SCAN_CONCURRENCY groups at a time (server-side counts unless full).
+
+    `cache` is the previous scan ({group_id: ScanDB}); groups are only re-read above its max_id.
+    res["unknown"] lists groups whose count failed; res["complete"] is set once every
+    dialog was listed, so the result can limit a delete. res["empty"] (rows to drop)
+    also gets cached groups a complete listing no longer has (left, kicked, deleted).
+    """
+    res = {"groups": [], "total": 0, "media": 0, "text": 0, "empty": [], "unknown": [], "complete": False,
+           "ts": time.time()}
+    gate = gate or FloodGate(); cache = cache or {}
+    me = await fp_me(client, cid, la, uid)
+    fin = 0
+    try:
+        pm = await send(cid, tx(la, "processing"), kb_job_cancel(la))
         pmid = pm.get("result", {}).get("message_id")
-        start = time.time()
-        
-        for i, d in enumerate(groups):
-            ids = []
-            try:
-                async for m in client.iter_messages(d.entity, from_user=me.id):
-                    ids.append(m.id)
-            except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 1)
-            except: continue
-            
-            if not ids: continue
-            gd = ge = 0
-            for j in range(0, len(ids), 50):
-                batch = ids[j:j + 50]
+        src = {}
+
+        async def count(ent):
+            # FloodWait: the gate pauses the whole account, then the group is retried
+            prev = cache.get(ent.id)
+            for _ in range(FP_FLOOD_RETRIES + 1):
                 try:
-                    await client.delete_messages(d.entity, batch, revoke=True)
-                    gd += len(batch); await asyncio.sleep(1)
-                except FloodWaitError as e:
-                    await asyncio.sleep(int(e.seconds * 1.5))
+                    if full:
+                        await gate.wait(); return await fp_iter_count(client, ent, me.id, prev)
+                    return await fp_count(client, ent, me.id, gate, prev)
+                except FloodWaitError as e: gate.flood(e.seconds)
+                except Exception: return None
+            return None
+
+        seen = set()
+
+        async def run(ent):
+            nonlocal fin
+            seen.add(ent.id)
+            r = await count(ent)
+            fin += 1
+            if r and r[0]:
+                gc, gm, gt, top, ids = r
+                g = {"id": ent.id, "title": fp_title(ent), "count": gc, "media": gm, "text": gt, "max_id": top}
+                if ids is not None: g["ids"] = ids
+                res["groups"].append(g)
+                res["total"] += gc; res["media"] += gm; res["text"] += gt
+            elif r and ent.id in cache: res["empty"].append(ent.id)
+            elif r is None: res["unknown"].append(ent.id)
+            # Partial results as groups finish
+            top = sorted(res["groups"], key=lambda g: -g["count"])[:5]
+            txt = (f"📊 {fin}/{src['seen']}{'+' if src['listing'] else ''} | 📂 {len(res['groups'])} | "
+                   f"💬 {res['total']} | 📸 {res['media']}")
+            if top: txt += "\n\n" + "\n".join(f"• {g['title'][:30]}: {g['count']}" for g in top)
+            progress(cid, pmid, txt, kb_job_cancel(la))
+
+        await fan_out(fp_groups(client, uid), run, FP_SCAN_CONCURRENCY, src)
+        res["groups"].sort(key=lambda g: -g["count"]); res["complete"] = True
+        res["empty"] += [g for g in cache if g not in seen]
+    except Exception as e:
+        print(f"footprint_scan error: {e}\n{traceback.format_exc()}")
+        if not fin:  # nothing was counted (e.g. the dialog list failed)
+            await send(cid, tx(la, "error", e=str(e)[:200])); raise JobSkipped() from e
+    return res
+
+async def my_footprint_delete(client, cid, la, job_id=None, ckpts=None, gate=None, uid=None, plan=None,
+                              private=False, filt=None):
+    """Delete all my messages from groups, FP_CONCURRENCY chats at a time.
+
+    Supergroups and basic groups go message by message (only my messages);
+    with private=True one-to-one chats are wiped with a bulk history revoke.
+    `filt` narrows the job server-side: {"days": N} -> offset_date, {"media": True}
+    -> one search pass per FP_MEDIA_FILTERS entry, {"groups": [ids]} -> only those,
+    {"marks": {group_id: id}} -> min_id (auto-clean high-water marks). res["marks"]
+    returns the highest id deleted per group.
+
+    Every request goes through the account's FloodGate; every batch is
+    checkpointed under job_id so the job can resume. `plan` ({group_id: scan
+    entry}) limits the work to groups a recent scan found messages in; entries
+    with "ids" are deleted from those ids plus whatever is newer than the scan.
+    A group whose listing fails keeps a "running" checkpoint and is retried once
+    from it after the other groups; if that fails too it goes to res["unlisted"].
+    res["err"] only counts message ids that could not be deleted.
+    """
+    res = {"done": 0, "err": 0, "gr": 0, "det": [], "new": 0, "rate": 0.0, "marks": {}, "touched": [],
+           "unlisted": []}
+    ckpts = ckpts or {}; gate = gate or FloodGate(); filt = filt or {}
+    marks = filt.get("marks") or {}
+    cutoff = datetime.now(timezone.utc) - timedelta(days=filt["days"]) if filt.get("days") else None
+    passes = FP_MEDIA_FILTERS if filt.get("media") else [None]
+    narrowed = bool(cutoff or filt.get("media"))  # scan ids cover every message, unusable then
+    want = set(filt.get("groups") or [])
+    for cp in ckpts.values():
+        if cp.status != "done": continue
+        res["touched"].append(cp.group_id)
+        res["done"] += cp.done; res["err"] += cp.err
+        if cp.done: res["gr"] += 1; res["det"].append(f"{cp.title}: {cp.done}")
+
+    async def ckpt(ent, last, gd, ge, status="running", stage=0):
+        if not job_id: return
+        try:
+            async with DBS() as db:
+                await save_ckpt(db, job_id, ent.id, fp_title(ent)[:255], last, gd, ge, status, stage)
+        except Exception as e: print(f"checkpoint error: {e}")
+
+    async def revoke_history(ent):
+        # messages.deleteHistory(revoke) removes the whole chat for both sides,
+        # up to ~100 messages per call server-side; repeat while offset > 0
+        gd = 0
+        try:
+            while True:
+                r = await gate.call(client, functions.messages.DeleteHistoryRequest(peer=ent, max_id=0, revoke=True))
+                gd += r.pts_count
+                if not r.offset: break
+        except Exception as e: print(f"revoke_history {ent.id}: {e}")
+        if not gd: return
+        res["new"] += gd; await ckpt(ent, 0, gd, 0, "done")
+        res["done"] += gd; res["gr"] += 1; res["det"].append(f"💬 {fp_title(ent)}: {gd}")
+
+    async def one(ent, retry=False):
+        cp = ckpts.get(ent.id)
+        if cp and cp.status == "done": return True
+        if fp_kind(ent) == "pm": await revoke_history(ent); return True
+        gd, ge, last, stage = (cp.done, cp.err, cp.last_msg_id, cp.stage or 0) if cp else (0, 0, 0, 0)
+        # Listing feeds deletion through a small queue: at most ~3 batches of ids
+        # per group in memory, and deleting starts after the first search page
+        q: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+        hand = None if (cp or narrowed) else (plan or {}).get(ent.id, {}).get("ids")
+        floor = plan[ent.id].get("max_id", 0) if hand is not None else 0
+        floor = max(floor, marks.get(str(ent.id), 0))
+        failed = False
+
+        async def produce(stage0, last0):
+            nonlocal failed
+            for si in range(stage0, len(passes)):
+                batch, low = [], last0 if si == stage0 else 0
+                for _ in range(FP_FLOOD_RETRIES + 1):
+                    await gate.wait()
                     try:
-                        await client.delete_messages(d.entity, batch, revoke=True)
-                        gd += len(batch)
-                    except: ge += len(batch)
-                except: ge += len(batch)
-            
-            res["done"] += gd; res["err"] += ge
-            if gd: res["gr"] += 1; res["det"].append(f"{d.entity.title}: {gd}")
-            
-            if pmid:
-                pct = int((i + 1) / max(len(groups), 1) * 100)
-                try: await edit(cid, pmid, f"🗑️ {pct}% | {res['done']} deleted")
-                except: pass
-    except: pass
+                        # max_id resumes below the checkpoint / the last id listed (0 = newest);
+                        # with handed-off ids only messages newer than the scan are listed
+                        async for m in client.iter_messages(ent, from_user=me.id, max_id=low, min_id=floor,
+                                                            offset_date=cutoff, filter=passes[si]):
+                            batch.append(m.id); low = m.id
+                            if len(batch) == FP_BATCH:
+                                await q.put((si, batch)); batch = []
+                                await gate.wait()  # one search page per FP_BATCH ids
+                        break
+                    except FloodWaitError as e: gate.flood(e.seconds)
+                    except Exception as e:
+                        print(f"listing {ent.id}: {e}"); failed = True; break
+                else: failed = True  # still flood-waited after FP_FLOOD_RETRIES
+                if batch: await q.put((si, batch))
+                # stop here: handed-off ids and later passes would move the
+                # checkpoint past messages that were never listed
+                if failed: await q.put(None); return
+            batch = []
+            for i in sorted(hand or (), reverse=True):
+                batch.append(i)
+                if len(batch) == FP_BATCH: await q.put((0, batch)); batch = []
+            if batch: await q.put((0, batch))
+            await q.put(None)
+
+        prod = asyncio.create_task(produce(stage, last)); seen = False
+        try:
+            while (item := await q.get()) is not None:
+                stage, batch = item; seen = True
+                try:
+                    aff = await gate.call(client.delete_messages, ent, batch, revoke=True)
+                    # pts_count = messages actually removed (handed-off ids may be gone already)
+                    n = sum(getattr(a, "pts_count", 0) for a in aff) if aff else len(batch)
+                    gd += n; res["new"] += n
+                    if n: res["marks"][str(ent.id)] = max(res["marks"].get(str(ent.id), 0), max(batch))
+                except Exception: ge += len(batch)
+                last = min(batch); await ckpt(ent, last, gd, ge, stage=stage)
+        finally: prod.cancel()
+        if failed:
+            res["touched"].append(ent.id)
+            await ckpt(ent, last, gd, ge, stage=stage)
+            if not retry:
+                # in-memory checkpoint so the retry resumes below `last` even without a job row
+                ckpts[ent.id] = JobGroupDB(group_id=ent.id, title=fp_title(ent)[:255], last_msg_id=last,
+                                           done=gd, err=ge, status="running", stage=stage)
+                return False
+            res["unlisted"].append(fp_title(ent)); res["done"] += gd; res["err"] += ge
+            if gd: res["gr"] += 1; res["det"].append(f"{fp_title(ent)}: {gd}")
+            return True
+        if not seen and not cp: return True
+        res["touched"].append(ent.id)
+        await ckpt(ent, last, gd, ge, "done", stage)
+        res["done"] += gd; res["err"] += ge
+        if gd: res["gr"] += 1; res["det"].append(f"{fp_title(ent)}: {gd}")
+        return True
+
+    me = await fp_me(client, cid, la, uid)
+    fin = 0
+    try:
+        pm = await send(cid, tx(la, "processing"), kb_job_cancel(la))
+        pmid = pm.get("result", {}).get("message_id")
+        start = time.time(); src = {}
+
+        async def groups():
+            async for e in fp_groups(client, uid, private):
+                # the scan plan only covers groups; private chats are not scanned
+                if want and e.id not in want: continue
+                if plan is None or e.id in plan or e.id in ckpts or fp_kind(e) == "pm": yield e
+
+        again = []
+
+        async def run(ent):
+            nonlocal fin
+            if not await one(ent): again.append(ent); return
+            fin += 1
+            progress(cid, pmid, f"🗑️ {fin}/{src['seen']}{'+' if src['listing'] else ''} | {res['done']} deleted | "
+                     f"⚡ {res['new'] / max(time.time() - start, 1):.1f}/s", kb_job_cancel(la))
+
+        await fan_out(groups(), run, FP_CONCURRENCY, src)
+        for ent in again:
+            await one(ent, retry=True); fin += 1
+        res["rate"] = round(res["new"] / max(time.time() - start, 1), 1)
+    except Exception as e:
+        print(f"footprint_delete error: {e}\n{traceback.format_exc()}")
+        if not fin and not res["new"] and not ckpts:  # failed before touching a group
+            await send(cid, tx(la, "error", e=str(e)[:200])); raise JobSkipped() from e
     return res
 
+async def my_footprint_export(client, cid, la, gate=None, uid=None, private=True):
+    """Stream my messages into gzip'd JSONL on disk and send it as documents.
+
+    Messages are written as they are paged, one page at a time. A part is closed at
+    EXPORT_PART_BYTES (compressed), uploaded and removed, so neither memory nor
+    disk grow with the history. Media is recorded by type only, not downloaded.
+    Parts are plaintext history, so they are readable by this process only (0600 in a 0700 dir).
+    """
+    res = {"msgs": 0, "gr": 0, "parts": 0, "err": 0}
+    gate = gate or FloodGate(); cur = {}; buf = []
+    for d in (os.path.dirname(EXPORT_DIR), EXPORT_DIR):
+        os.makedirs(d, mode=0o700, exist_ok=True); os.chmod(d, 0o700)
+
+    def open_part():
+        cur["path"] = os.path.join(EXPORT_DIR, f"{uid or cid}-{int(time.time())}-{res['parts'] + 1}.jsonl.gz")
+        cur["raw"] = os.fdopen(os.open(cur["path"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb")
+        cur["gz"] = gzip.GzipFile(fileobj=cur["raw"], mode="wb", compresslevel=EXPORT_GZ_LEVEL)
+
+    async def flush():
+        # compress off the event loop, one page of messages at a time
+        data = b"".join(buf); buf.clear()
+        await asyncio.to_thread(cur["gz"].write, data)
+        if cur["raw"].tell() >= EXPORT_PART_BYTES: await ship(); open_part()
+
+    def close_part():
+        cur.pop("gz").close(); cur.pop("raw").close()
+        return cur.pop("path")
+
+    async def ship():
+        path = close_part(); res["parts"] += 1
+        try:
+            r = await send_doc(cid, path, tx(la, "export_part", n=res["parts"]))
+            if not r.get("ok"): res["err"] += 1
+        finally: os.remove(path)
+
+    me = await fp_me(client, cid, la, uid)
+    try:
+        pm = await send(cid, tx(la, "processing"), kb_job_cancel(la))
+        pmid = pm.get("result", {}).get("message_id")
+        open_part()
+        async for ent in fp_groups(client, uid, private):
+            title = fp_title(ent); n = 0; last = 0
+            for _ in range(FP_FLOOD_RETRIES + 1):
+                try:
+                    await gate.wait()
+                    # newest first; after a FloodWait continue below the last id written
+                    async for m in client.iter_messages(ent, from_user=me.id, offset_id=last):
+                        buf.append((json.dumps({
+                            "chat_id": ent.id, "chat": title, "id": m.id, "date": m.date.isoformat(),
+                            "text": m.message or "", "media": type(m.media).__name__ if m.media else None,
+                            "reply_to": m.reply_to_msg_id}, ensure_ascii=False) + "\n").encode())
+                        last = m.id; n += 1; res["msgs"] += 1
+                        if len(buf) >= FP_BATCH: await flush()
+                    gate.ok(); break
+                except FloodWaitError as e: gate.flood(e.seconds)
+                except Exception: res["err"] += 1; break
+            if n:
+                res["gr"] += 1
+                progress(cid, pmid, f"📦 {res['gr']} | {res['msgs']} msgs", kb_job_cancel(la))
+            if buf: await flush()
+        if res["msgs"]: await ship()
+    except Exception as e: print(f"footprint_export error: {e}\n{traceback.format_exc()}")
+    finally:
+        # cancelled or failed mid-part: nothing is left behind on disk
+        if "path" in cur:
+            try: os.remove(close_part())
+            except OSError: pass
+    return res
+
+# ══════════════════════════════
+# JOB EXECUTOR
+# ══════════════════════════════
+class JobSkipped(Exception):
+    """Raised by a job that gave up before doing any work (it has told the user why);
+    a charged job is refunded."""
+
+class Job:
+    def __init__(self, uid, cid, la, kind, fn, args, charged=False):
+        self.uid, self.cid, self.la, self.kind, self.fn, self.args = uid, cid, la, kind, fn, args
+        self.enq = time.monotonic(); self.started = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False; self.charged = charged
+
+class JobPool:
+    """Bounded worker pool for heavy jobs; at most one queued/running job per user."""
+    def __init__(self, workers, maxq):
+        self.n, self.maxq = workers, maxq
+        self.q: asyncio.Queue = asyncio.Queue()
+        self.pending: List[Job] = []
+        self.active: Dict[int, Job] = {}
+        self.workers: List[asyncio.Task] = []
+        self.waits = deque(maxlen=200)
+        self.done = self.shed = self.cancelled = self.failed = 0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.n)]
+
+    async def stop(self):
+        for w in self.workers: w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True); self.workers = []
+        for job in self.pending: await self._refund(job)  # queued jobs are lost on shutdown
+
+    async def _refund(self, job):
+        if not job.charged: return
+        job.charged = False
+        try:
+            async with DBS() as db: await refund_credit(db, job.uid)
+        except Exception as e: print(f"refund error uid={job.uid}: {e}")
+
+    def busy(self, uid): return uid in self.active
+    def full(self): return len(self.pending) >= self.maxq
+    def running(self): return len(self.active) - len(self.pending)
+
+    def submit(self, uid, cid, la, kind, fn, *args, charged=False):
+        """Queue a job; returns its queue position (0 = a worker is free, starts now).
+        charged=True: a credit was taken for it and is refunded if it never runs."""
+        job = Job(uid, cid, la, kind, fn, args, charged)
+        self.active[uid] = job; self.pending.append(job); self.q.put_nowait(job)
+        return max(0, len(self.pending) - (self.n - self.running()))
+
+    def cancel(self, uid):
+        job = self.active.get(uid)
+        if not job: return False
+        if job.task is None:
+            job.cancelled = True; self.pending.remove(job); self.active.pop(uid, None)
+            spawn(self._refund(job))
+        else: job.task.cancel()
+        self.cancelled += 1; return True
+
+    def stats(self):
+        w = list(self.waits)
+        return {"workers": self.n, "running": self.running(), "queued": len(self.pending),
+                "avg_wait": round(sum(w) / len(w), 1) if w else 0.0, "max_wait": round(max(w), 1) if w else 0.0,
+                "done": self.done, "failed": self.failed, "cancelled": self.cancelled, "shed": self.shed}
+
+    async def _worker(self):
+        while True:
+            job = await self.q.get()
+            if job.cancelled: continue
+            self.pending.remove(job)
+            job.started = time.monotonic(); self.waits.append(job.started - job.enq)
+            job.task = asyncio.create_task(job.fn(*job.args))
+            try: await asyncio.wait([job.task])
+            except asyncio.CancelledError:
+                job.task.cancel(); raise
+            finally:
+                if self.active.get(job.uid) is job: del self.active[job.uid]
+            if job.task.cancelled(): continue  # the /cancel handler already replied
+            if job.task.exception():
+                e = job.task.exception()
+                if isinstance(e, JobSkipped): await self._refund(job); continue
+                self.failed += 1
+                if isinstance(e, SessionExpired): await self._refund(job)
+                if isinstance(e, (SessionExpired, UnauthorizedError)):
+                    if not isinstance(e, SessionExpired): await expire_session(job.uid)
+                    await send(job.cid, tx(job.la, "session_expired")); continue
+                print(f"❌ job {job.kind} uid={job.uid}: {e}\n{''.join(traceback.format_exception(e))}")
+                await send(job.cid, tx(job.la, "error", e=str(e)[:200]))
+            else: self.done += 1
+
+jobs = JobPool(JOB_WORKERS, JOB_QUEUE_MAX)
+
+async def start_job(db, u, cid, la, kind, fn, *args, charge=True):
+    """Per-user/queue limits, atomic charge, then enqueue. Returns True if queued."""
+    if jobs.busy(u.id): await send(cid, tx(la, "job_busy_self"), kb_job_cancel(la)); return False
+    if jobs.full(): jobs.shed += 1; await send(cid, tx(la, "job_shed")); return False
+    if charge and not await use_credit(db, u.id, kind): await send(cid, tx(la, "no_credit")); return False
+    pos = jobs.submit(u.id, cid, la, kind, fn, *args, charged=charge)
+    if pos: await send(cid, tx(la, "job_queued", pos=pos), kb_job_cancel(la))
+    return True
+
 # ══════════════════════════════
 # BACKGROUND TASKS
 # ══════════════════════════════
@@ -618,7 +2004,7 @@ async def bg_stalk(uid, cid, target_str, la):
             return
         
         # Save state for group selection
-        sset(uid, "stalk_view", target_id=target_id, target_name=target_name, items=found)
+        await sset(uid, "stalk_view", target_id=target_id, target_name=target_name, items=found)
         
         txt = tx(la, "stalk_panel", name=target_name, gr=len(found), msgs=total)
         await send(cid, txt, kb_groups_inline(found, 0, 8, "sg"))
@@ -626,7 +2012,7 @@ async def bg_stalk(uid, cid, target_str, la):
 async def bg_stalk_msgs(uid, cid, group_id, la):
     """Show messages from target in specific group."""
     async with DBS() as db:
-        _, sd = sget(uid)
+        _, sd = await sget(uid)
         target_id = sd.get("target_id")
         target_name = sd.get("target_name", "?")
         if not target_id: return
@@ -661,60 +2047,154 @@ async def bg_stalk_msgs(uid, cid, group_id, la):
                 txt += f'📅 <code>{m["date"]}</code> {link}\n💬 {m["text"]}\n{"─" * 25}\n'
             
             await send(cid, txt)
-            await asyncio.sleep(0.3)
 
-async def bg_footprint_scan(uid, cid, la):
+def fp_text(la, r):
+    txt = tx(la, "footprint_info", gr=len(r["groups"]), msgs=r["total"], md=r["media"], tx=r["text"])
+    if r["groups"]:
+        txt += "\n\n"
+        for g in r["groups"][:20]:
+            txt += f"• {g['title']}: {g['count']} ({g.get('media', 0)}📸)\n"
+    if r.get("unknown"): txt += "\n" + tx(la, "footprint_unknown", n=len(r["unknown"]))
+    return txt
+
+def scan_from_cache(cache):
+    groups = sorted(({"id": c.group_id, "title": c.title, "count": c.count, "media": c.media,
+                      "text": c.text, "max_id": c.max_id} for c in cache.values() if c.count),
+                    key=lambda g: -g["count"])
+    return {"groups": groups, "total": sum(g["count"] for g in groups),
+            "media": sum(g["media"] for g in groups), "text": sum(g["text"] for g in groups), "empty": []}
+
+async def bg_footprint_scan(uid, cid, la, full=False):
     """Scan my footprint - needs user login."""
     async with DBS() as db:
         ss = await dec_sess(db, uid)
         if not ss:
             await send(cid, tx(la, "footprint_need_login"))
-            return
+            raise JobSkipped()
         
-        client = await get_user_client(uid, ss)
-        r = await my_footprint_scan(client, cid, la)
+        client = await job_client(uid, ss, cid, la)
+        cache = await get_scan(db, uid)
+        r = await my_footprint_scan(client, cid, la, full or FP_SCAN_MODE == "full", flood_gate(uid), cache, uid)
+        await save_scan(db, uid, r["groups"], r["empty"])
         
-        sset(uid, "fp_data", scan=r)
+        await sset(uid, "fp_data", scan=r)  # handed to the delete job (groups + ids)
         
         logged = True
-        txt = tx(la, "footprint_info", gr=len(r["groups"]), msgs=r["total"], md=r["media"], tx=r["text"])
-        
-        if r["groups"]:
-            txt += "\n\n"
-            for g in r["groups"][:20]:
-                txt += f"• {g['title']}: {g['count']} ({g.get('media', 0)}📸)\n"
-        
-        await send(cid, txt, kb_footprint(la, logged_in=logged))
+        await send(cid, fp_text(la, r), kb_footprint(la, logged_in=logged))
 
-async def bg_footprint_delete(uid, cid, la):
-    """Delete my footprint."""
+async def bg_footprint_delete(uid, cid, la, job_id=None, private=False, filt=None, kind="delete"):
+    """Delete my footprint (optionally filtered). Pass job_id to resume a checkpointed job.
+    Returns the engine result."""
     async with DBS() as db:
         ss = await dec_sess(db, uid)
         if not ss:
-            await send(cid, tx(la, "not_logged")); return
+            if job_id: await finish_job(db, job_id, "failed")
+            await send(cid, tx(la, "not_logged")); raise JobSkipped()
         
-        client = await get_user_client(uid, ss)
-        start = time.time()
-        r = await my_footprint_delete(client, cid, la)
+        if job_id:
+            ckpts = await get_ckpts(db, job_id)
+            j = await db.get(JobDB, job_id); params = json.loads(j.params or "{}") if j else {}
+            plan = {g: {} for g in params["groups"]} if "groups" in params else None
+            private = params.get("private", False); filt = params.get("filt")
+        else:
+            # Start from the groups a fresh, complete scan found (plus the ones it could not
+            # count, walked in full); without one every group is walked
+            _, sd = await sget(uid); scan = sd.get("scan") or {}
+            plan = None
+            if scan.get("complete") and time.time() - scan.get("ts", 0) < FP_HANDOFF_TTL:
+                plan = {g["id"]: g for g in scan["groups"]} | {g: {} for g in scan.get("unknown", ())}
+            params = {"groups": list(plan)} if plan is not None else {}
+            if filt and (filt.get("days") or filt.get("media")): private = False  # revoke is all-or-nothing
+            params["private"] = private; params["filt"] = filt or {}
+            job_id = await create_job(db, uid, cid, kind, la, params); ckpts = {}
+        try:
+            client = await job_client(uid, ss, cid, la)
+            start = time.time()
+            r = await my_footprint_delete(client, cid, la, job_id, ckpts, flood_gate(uid), uid, plan, private, filt)
+        except asyncio.CancelledError:
+            # user cancel marks the row; shutdown leaves it resumable. Either way the
+            # groups touched so far no longer match their stored scan.
+            try: await save_scan(db, uid, [], list(await get_ckpts(db, job_id)))
+            except Exception: pass
+            raise
+        except Exception:
+            await finish_job(db, job_id, "failed"); raise
+        await finish_job(db, job_id, "done", r["done"], r["err"])
+        # counts of processed groups are stale now: drop them so the next scan recounts
+        await save_scan(db, uid, [], r["touched"]); await supd(uid, scan=None)
         el = time.time() - start
         ts = f"{int(el // 60)}m {int(el % 60)}s"
         
-        txt = tx(la, "footprint_done", done=r["done"], gr=r["gr"], time=ts, err=r["err"])
+        txt = tx(la, "footprint_done", done=r["done"], gr=r["gr"], time=ts, err=r["err"], rate=r["rate"])
+        if kind == "autoclean": txt = "🔁 " + txt
         if r["det"]:
             txt += "\n\n" + "\n".join(f"• {d}" for d in r["det"][:20])
+        if r["unlisted"]:
+            txt += "\n\n" + tx(la, "footprint_unlisted", n=len(r["unlisted"]), names=", ".join(r["unlisted"][:10]))
         await send(cid, txt)
+        return r
+
+async def bg_footprint_export(uid, cid, la):
+    """Backup of my messages (groups + private chats) as compressed JSONL documents."""
+    async with DBS() as db:
+        ss = await dec_sess(db, uid)
+        if not ss:
+            await send(cid, tx(la, "not_logged")); return
+        client = await job_client(uid, ss, cid, la)
+    t0 = time.time()
+    r = await my_footprint_export(client, cid, la, flood_gate(uid), uid)
+    await send(cid, tx(la, "export_done", msgs=r["msgs"], gr=r["gr"], parts=r["parts"],
+                       time=f"{int(time.time() - t0)}s", err=r["err"]), kb_footprint(la, logged_in=True))
+
+async def bg_autoclean(uid, cid, la, job_id=None):
+    """One run of the user's recurring cleanup; advances the per-group marks."""
+    async with DBS() as db:
+        ac = await db.get(AutoCleanDB, uid)
+        if not ac or not ac.enabled or ac.paused:
+            if job_id: await finish_job(db, job_id, "cancelled")
+            raise JobSkipped()
+        filt = {"days": ac.days, "marks": json.loads(ac.marks or "{}")}
+    r = await bg_footprint_delete(uid, cid, la, job_id, False, filt, "autoclean")
+    async with DBS() as db:
+        ac = await db.get(AutoCleanDB, uid)
+        if not ac: return
+        marks = json.loads(ac.marks or "{}")
+        for g, m in r["marks"].items(): marks[g] = max(marks.get(g, 0), m)
+        ac.marks = json.dumps(marks); ac.last_run = datetime.now(timezone.utc); await db.commit()
+
+async def autoclean_loop():
+    """Start due auto-clean runs, a few per tick; next_run is pushed (with jitter) before queueing.
+    Entries without a live session are paused (not charged) until the user logs in again."""
+    while True:
+        await asyncio.sleep(AUTO_TICK)
+        try:
+            async with DBS() as db:
+                for ac in await due_autocleans(db, AUTO_BATCH):
+                    if jobs.busy(ac.user_id) or jobs.full():
+                        ac.next_run = auto_next(1); continue  # retry in about an hour
+                    ac.next_run = auto_next(ac.every_hours)
+                    if not await get_auth_session(db, ac.user_id):
+                        # sessions expire 24h after login; don't charge a run that can't log in
+                        ac.paused = True; await send(ac.chat_id, tx(ac.lang, "auto_paused")); continue
+                    if not await use_credit(db, ac.user_id, "autoclean"):
+                        await send(ac.chat_id, tx(ac.lang, "auto_no_credit")); continue
+                    jobs.submit(ac.user_id, ac.chat_id, ac.lang, "autoclean", bg_autoclean,
+                                ac.user_id, ac.chat_id, ac.lang, charged=True)
+                await db.commit()
+        except Exception as e: print(f"autoclean_loop error: {e}\n{traceback.format_exc()}")
 
 async def bg_login(uid, cid, phone, la):
     async with DBS() as db:
         try:
-            client = await new_user_client()
+            client = await new_user_client(); logins.put(uid, client)
             result = await client.send_code_request(phone)
+            # stored once, only as a fallback if the pending client is gone by the next step
             ss = client.session.save()
             await save_sess(db, uid, phone, ss, result.phone_code_hash)
-            sset(uid, "code", phone=phone, ph=result.phone_code_hash)
+            await sset(uid, "code", phone=phone, ph=result.phone_code_hash)
             await send(cid, tx(la, "code_ask"))
-            await client.disconnect()
         except Exception as e:
+            await logins.drop(uid)
             await send(cid, tx(la, "login_fail", e=str(e)[:200]))
 
 async def bg_code(uid, cid, code, la):
@@ -722,23 +2202,21 @@ async def bg_code(uid, cid, code, la):
         try:
             so = await get_any_sess(db, uid)
             if not so or not so.enc_session: await send(cid, tx(la, "login_fail", e="No session")); return
-            ss = fernet.decrypt(so.enc_session.encode()).decode()
-            client = TelegramClient(StringSession(ss), API_ID, API_HASH)
-            await client.connect()
-            _, sd = sget(uid)
+            client = await login_client(uid, so)
+            _, sd = await sget(uid)
             try:
                 await client.sign_in(phone=sd.get("phone", so.phone), code=code,
                                       phone_code_hash=sd.get("ph", so.phone_hash))
                 nss = client.session.save()
-                await auth_sess(db, uid, nss); sdel(uid)
+                await auth_sess(db, uid, nss); await sdel(uid)
+                logins.pop(uid); await clients.adopt(uid, client)
                 await send(cid, tx(la, "login_ok"), kb_main(la, uid in ADMIN_IDS))
             except SessionPasswordNeededError:
-                nss = client.session.save()
-                so.enc_session = fernet.encrypt(nss.encode()).decode(); await db.commit()
-                sset(uid, "2fa"); await send(cid, tx(la, "2fa_ask"))
-            finally: await client.disconnect()
+                # same auth key as the stored fallback, so nothing to re-save; the client stays pending
+                await sset(uid, "2fa"); await send(cid, tx(la, "2fa_ask"))
         except PhoneCodeInvalidError: await send(cid, tx(la, "login_fail", e="Wrong code"))
-        except PhoneCodeExpiredError: sdel(uid); await send(cid, tx(la, "login_fail", e="Expired"))
+        except PhoneCodeExpiredError:
+            await sdel(uid); await logins.drop(uid); await send(cid, tx(la, "login_fail", e="Expired"))
         except Exception as e: await send(cid, tx(la, "login_fail", e=str(e)[:200]))
 
 async def bg_2fa(uid, cid, pwd, la):
@@ -746,15 +2224,12 @@ async def bg_2fa(uid, cid, pwd, la):
         try:
             so = await get_any_sess(db, uid)
             if not so or not so.enc_session: return
-            ss = fernet.decrypt(so.enc_session.encode()).decode()
-            client = TelegramClient(StringSession(ss), API_ID, API_HASH)
-            await client.connect()
-            try:
-                await client.sign_in(password=pwd)
-                nss = client.session.save()
-                await auth_sess(db, uid, nss); sdel(uid)
-                await send(cid, tx(la, "login_ok"), kb_main(la, uid in ADMIN_IDS))
-            finally: await client.disconnect()
+            client = await login_client(uid, so)
+            await client.sign_in(password=pwd)
+            nss = client.session.save()
+            await auth_sess(db, uid, nss); await sdel(uid)
+            logins.pop(uid); await clients.adopt(uid, client)
+            await send(cid, tx(la, "login_ok"), kb_main(la, uid in ADMIN_IDS))
         except PasswordHashInvalidError: await send(cid, tx(la, "login_fail", e="Wrong 2FA"))
         except Exception as e: await send(cid, tx(la, "login_fail", e=str(e)[:200]))
 
@@ -762,26 +2237,157 @@ async def bg_logout(uid, cid, la):
     async with DBS() as db:
         ss = await dec_sess(db, uid)
         if ss:
-            try:
-                c = TelegramClient(StringSession(ss), API_ID, API_HASH)
-                await c.connect(); await c.log_out(); await c.disconnect()
+            try: await (await clients.get(uid, ss)).log_out()
             except: pass
-        await del_sess(db, uid); user_clients.pop(uid, None); sdel(uid)
+        await clients.drop(uid, save=False); await logins.drop(uid)
+        await del_sess(db, uid); dialog_cache.pop(uid, None); await sdel(uid)
         await send(cid, tx(la, "logout_ok"), kb_main(la, uid in ADMIN_IDS))
 
-async def bg_broadcast(auid, cid, text, la):
+async def bg_broadcast(auid, cid, text, la, job_id=None):
+    """Send `text` to every active user, BCAST_CONCURRENCY at a time (the outbox sets the rate).
+
+    Recipients are read by id, one BCAST_PAGE at a time. After each page the cursor and
+    counters are saved on the job row, so a restart resumes after the last full page.
+    Users who blocked the bot (403) are flagged and skipped by later broadcasts.
+    """
+    async with DBS() as db:
+        if job_id:
+            j = await db.get(JobDB, job_id); p = json.loads(j.params or "{}"); text = p["text"]
+        else:
+            p = {"text": text, "cursor": 0, "ok": 0, "failed": 0, "blocked": 0, "secs": 0}
+            job_id = await create_job(db, auid, cid, "broadcast", la, p)
+    pm = await send(cid, tx(la, "processing"), kb_job_cancel(la))
+    pmid = pm.get("result", {}).get("message_id")
+    body = f"📢\n\n{text}"; sem = asyncio.Semaphore(BCAST_CONCURRENCY)
+    t0 = time.time(); secs0 = p["secs"]
+
+    async def one(uid, blocked):
+        async with sem:
+            r = await send(uid, body, prio=P_BULK)
+        if r.get("ok"): p["ok"] += 1
+        elif r.get("error_code") == 403: blocked.append(uid)
+        else: p["failed"] += 1
+
+    while True:
+        async with DBS() as db:
+            r = await db.execute(select(UserDB.id).where(and_(
+                UserDB.id > p["cursor"], UserDB.id != auid, UserDB.is_banned == False, UserDB.blocked == False))
+                .order_by(UserDB.id).limit(BCAST_PAGE))
+            ids = r.scalars().all()
+        if not ids: break
+        blocked: List[int] = []
+        await asyncio.gather(*(one(u, blocked) for u in ids))
+        async with DBS() as db:
+            if blocked:
+                await db.execute(update(UserDB).where(UserDB.id.in_(blocked)).values(blocked=True))
+                for b in blocked: user_cache.drop(b)
+            p["blocked"] += len(blocked); p["cursor"] = ids[-1]; p["secs"] = secs0 + time.time() - t0
+            await save_job(db, job_id, p, p["ok"], p["failed"])
+        progress(cid, pmid, f"📢 ✅ {p['ok']} | ❌ {p['failed']} | 🚫 {p['blocked']}", kb_job_cancel(la))
+
+    async with DBS() as db: await finish_job(db, job_id, "done", p["ok"], p["failed"])
+    el = secs0 + time.time() - t0
+    await send(cid, tx(la, "a_bcast_done", ok=p["ok"], fail=p["failed"], blocked=p["blocked"],
+                       rate=round(p["ok"] / max(el, 1), 1), time=f"{int(el // 60)}m {int(el % 60)}s"), kb_admin_menu(la))
+
+async def resume_jobs():
+    """Re-queue delete/broadcast jobs that were still running when the process stopped (already paid)."""
     async with DBS() as db:
-        users = await get_all_users(db); n = 0
-        for u in users:
-            if u.id == auid: continue
-            try: await send(u.id, f"📢\n\n{text}"); n += 1; await asyncio.sleep(0.1)
-            except: continue
-        await send(cid, tx(la, "a_bcast_ok", n=n), kb_admin_menu(la))
+        for j in await get_resumable_jobs(db):
+            if jobs.busy(j.user_id): continue
+            if j.kind == "broadcast":
+                jobs.submit(j.user_id, j.chat_id, j.lang, j.kind, bg_broadcast, j.user_id, j.chat_id, None, j.lang, j.id)
+            else:
+                fn = bg_autoclean if j.kind == "autoclean" else bg_footprint_delete
+                jobs.submit(j.user_id, j.chat_id, j.lang, j.kind, fn, j.user_id, j.chat_id, j.lang, j.id)
+            await send(j.chat_id, tx(j.lang, "job_resumed"))
+            print(f"♻️ resumed {j.kind} job {j.id} for {j.user_id}")
+
+# ══════════════════════════════
+# UPDATE INTAKE
+# ══════════════════════════════
+class RecentIds:
+    """LRU + TTL set of recently seen update_ids, drops webhook redeliveries."""
+    def __init__(self, size, ttl):
+        self.size, self.ttl = size, ttl
+        self.d: OrderedDict = OrderedDict()
+
+    def seen(self, k):
+        now = time.monotonic()
+        while self.d and (len(self.d) >= self.size or next(iter(self.d.values())) < now - self.ttl):
+            self.d.popitem(last=False)
+        if k in self.d: return True
+        self.d[k] = now; return False
+
+    def forget(self, k): self.d.pop(k, None)
+
+class BgTasks:
+    """Stand-in for FastAPI BackgroundTasks outside a request: starts the task right away."""
+    def add_task(self, fn, *a, **kw): spawn(fn(*a, **kw))
+
+def update_uid(upd):
+    for k in ("message", "callback_query"):
+        if k in upd: return (upd[k].get("from") or {}).get("id") or 0
+    return 0
+
+async def handle_update(upd):
+    async with DBS() as db:
+        try:
+            if "message" in upd: await on_msg(db, upd["message"], BgTasks())
+            elif "callback_query" in upd: await on_cb(db, upd["callback_query"], BgTasks())
+        except Exception as e:
+            print(f"❌ {e}\n{traceback.format_exc()}")
+
+class UpdateQueue:
+    """Per-user FIFO of updates, drained by one task per user with updates waiting.
+
+    A user's updates run in order; a handler waiting on its own replies only delays
+    that user. At most `workers` handlers run at once, `maxsize` updates wait in total.
+    """
+    def __init__(self, workers, maxsize):
+        self.workers, self.maxsize = workers, maxsize
+        self.users: Dict[int, deque] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.sem: Optional[asyncio.Semaphore] = None
+        self.n = 0
+
+    def put(self, upd):
+        if self.n >= self.maxsize or self.sem is None: return False
+        uid = update_uid(upd)
+        self.users.setdefault(uid, deque()).append(upd); self.n += 1
+        if uid not in self.tasks: self.tasks[uid] = asyncio.create_task(self._drain(uid))
+        return True
+
+    def depth(self): return self.n
+
+    def start(self):
+        if self.sem is None: self.sem = asyncio.Semaphore(self.workers)
+
+    async def stop(self):
+        try: await asyncio.wait_for(asyncio.gather(*self.tasks.values(), return_exceptions=True), UPD_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError: print(f"⚠️ dropping {self.depth()} queued updates")
+        ts = list(self.tasks.values())
+        for t in ts: t.cancel()
+        await asyncio.gather(*ts, return_exceptions=True); self.sem = None
+
+    async def _drain(self, uid):
+        q = self.users[uid]
+        try:
+            while q:
+                async with self.sem:
+                    try: await handle_update(q[0])
+                    finally: q.popleft(); self.n -= 1
+        finally:
+            self.tasks.pop(uid, None)
+            if not q: self.users.pop(uid, None)
+
+recent_updates = RecentIds(UPD_DEDUP_SIZE, UPD_DEDUP_TTL)
+updates = UpdateQueue(UPD_CONSUMERS, UPD_QUEUE_MAX)
 
 # ══════════════════════════════
 # MESSAGE HANDLER
 # ══════════════════════════════
-async def on_msg(db, msg, bg: BackgroundTasks):
+async def on_msg(db, msg, bg: BgTasks):
     cid = msg.get("chat", {}).get("id")
     uid = msg.get("from", {}).get("id")
     fname = msg.get("from", {}).get("first_name", "")
@@ -793,7 +2399,7 @@ async def on_msg(db, msg, bg: BackgroundTasks):
     la = u.lang; ia = u.is_admin or uid in ADMIN_IDS
     if u.is_banned: await send(cid, tx(la, "banned")); return
 
-    st, sd = sget(uid)
+    st, sd = await sget(uid)
 
     # Login flow
     if st == "code": bg.add_task(bg_code, uid, cid, text, la); return
@@ -804,14 +2410,12 @@ async def on_msg(db, msg, bg: BackgroundTasks):
 
     # Stalk target input
     if st == "stalk_input":
-        sdel(uid)
-        if not await has_credit(u): await send(cid, tx(la, "no_credit")); return
-        await use_credit(db, uid)
-        bg.add_task(bg_stalk, uid, cid, text, la); return
+        await sdel(uid)
+        await start_job(db, u, cid, la, "stalk", bg_stalk, uid, cid, text, la); return
 
     # Admin states
     if st == "a_credit" and ia:
-        sdel(uid); parts = text.split()
+        await sdel(uid); parts = text.split()
         if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
             total = await add_credits(db, int(parts[0]), int(parts[1]))
             if total is not None: await send(cid, tx(la, "a_credit_ok", uid=parts[0], n=parts[1], total=total), kb_admin_menu(la))
@@ -819,7 +2423,7 @@ async def on_msg(db, msg, bg: BackgroundTasks):
         else: await send(cid, tx(la, "a_credit_fail"), kb_admin_menu(la))
         return
     if st == "a_setcr" and ia:
-        sdel(uid); parts = text.split()
+        await sdel(uid); parts = text.split()
         if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
             r = await set_credits(db, int(parts[0]), int(parts[1]))
             if r is not None: await send(cid, tx(la, "a_setcr_ok", uid=parts[0], n=parts[1]), kb_admin_menu(la))
@@ -827,21 +2431,21 @@ async def on_msg(db, msg, bg: BackgroundTasks):
         else: await send(cid, tx(la, "a_credit_fail"), kb_admin_menu(la))
         return
     if st == "a_ban" and ia:
-        sdel(uid)
+        await sdel(uid)
         if text.isdigit():
             ok = await ban_user(db, int(text))
             await send(cid, tx(la, "a_ban_ok", uid=text) if ok else tx(la, "a_notfound"), kb_admin_menu(la))
         else: await send(cid, tx(la, "a_notfound"), kb_admin_menu(la))
         return
     if st == "a_unban" and ia:
-        sdel(uid)
+        await sdel(uid)
         if text.isdigit():
             ok = await unban_user(db, int(text))
             await send(cid, tx(la, "a_unban_ok", uid=text) if ok else tx(la, "a_notfound"), kb_admin_menu(la))
         else: await send(cid, tx(la, "a_notfound"), kb_admin_menu(la))
         return
     if st == "a_lookup" and ia:
-        sdel(uid)
+        await sdel(uid)
         if text.isdigit():
             tu = await lookup_user(db, int(text))
             if tu: await send(cid, tx(la, "a_user_info", uid=tu.id, name=tu.first_name or "?",
@@ -852,21 +2456,24 @@ async def on_msg(db, msg, bg: BackgroundTasks):
         else: await send(cid, tx(la, "a_notfound"), kb_admin_menu(la))
         return
     if st == "a_bcast" and ia:
-        sdel(uid); bg.add_task(bg_broadcast, uid, cid, text, la); return
+        await sdel(uid); await start_job(db, u, cid, la, "broadcast", bg_broadcast, uid, cid, text, la, charge=False); return
 
     # ── Keyboard Buttons ──
     if text in ["👁 استاک", "👁 Stalk"]:
         if not await has_credit(u): await send(cid, tx(la, "no_credit")); return
-        sset(uid, "stalk_input")
+        await sset(uid, "stalk_input")
         await send(cid, tx(la, "stalk_ask"), kb_back(la)); return
 
     if text in ["🧹 ردپای من", "🧹 My Footprint"]:
         # Check if logged in
         sess = await get_auth_session(db, uid)
         if sess:
-            if not await has_credit(u): await send(cid, tx(la, "no_credit")); return
-            await use_credit(db, uid)
-            bg.add_task(bg_footprint_scan, uid, cid, la)
+            # Show the last stored scan right away while the refresh runs
+            cache = await get_scan(db, uid)
+            if cache:
+                mins = int((datetime.now(timezone.utc) - max(c.updated for c in cache.values())).total_seconds() // 60)
+                await send(cid, fp_text(la, scan_from_cache(cache)) + "\n" + tx(la, "footprint_cached", ago=mins))
+            await start_job(db, u, cid, la, "scan", bg_footprint_scan, uid, cid, la)
         else:
             await send(cid, tx(la, "footprint_need_login"), kb_main(la, ia))
         return
@@ -879,43 +2486,51 @@ async def on_msg(db, msg, bg: BackgroundTasks):
             date=u.joined.strftime("%Y-%m-%d") if u.joined else "?"), kb_main(la, ia)); return
 
     if text in ["📱 ورود", "📱 Login"]:
-        sset(uid, "phone"); await send(cid, tx(la, "phone_ask"), kb_back(la)); return
+        await sset(uid, "phone"); await send(cid, tx(la, "phone_ask"), kb_back(la)); return
 
     if text in ["❓ راهنما", "❓ Help"]:
         await send(cid, tx(la, "help", cr=DEFAULT_CREDITS), kb_main(la, ia)); return
 
     if text in ["👑 مدیریت", "👑 Admin"] and ia:
         total, banned, logged = await get_stats(db)
-        await send(cid, tx(la, "admin_panel", total=total, banned=banned, logged=logged), kb_admin_menu(la)); return
+        js = jobs.stats()
+        txt = tx(la, "admin_panel", total=total, banned=banned, logged=logged)
+        txt += f"\n⚙️ {js['running']}/{js['workers']} | 📥 {js['queued']} | ⏱ {js['avg_wait']}s | 🚦 {js['shed']}"
+        cs = clients.stats()
+        txt += f"\n🔌 {cs['size']}/{cs['max']} | ✅ {cs['hits']} | ➕ {cs['misses']} | ♻️ {cs['evicted'] + cs['idle_closed']}"
+        await send(cid, txt, kb_admin_menu(la)); return
 
     if text in ["🔙 بازگشت", "🔙 Back"]:
-        sdel(uid)
+        await sdel(uid)
         await send(cid, tx(la, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(la, ia)); return
 
     # Admin buttons
     if ia:
-        if text in ["💎 اعتبار", "💎 Credits"]: sset(uid, "a_credit"); await send(cid, tx(la, "a_credit_ask"), kb_back(la)); return
-        if text in ["🔧 تنظیم", "🔧 Set"]: sset(uid, "a_setcr"); await send(cid, tx(la, "a_setcr_ask"), kb_back(la)); return
-        if text in ["🔎 جستجو", "🔎 Lookup"]: sset(uid, "a_lookup"); await send(cid, tx(la, "a_lookup_ask"), kb_back(la)); return
-        if text in ["🚫 بن", "🚫 Ban"]: sset(uid, "a_ban"); await send(cid, tx(la, "a_ban_ask"), kb_back(la)); return
-        if text in ["✅ آنبن", "✅ Unban"]: sset(uid, "a_unban"); await send(cid, tx(la, "a_unban_ask"), kb_back(la)); return
-        if text in ["📢 پیام", "📢 Broadcast"]: sset(uid, "a_bcast"); await send(cid, tx(la, "a_bcast_ask"), kb_back(la)); return
+        if text in ["💎 اعتبار", "💎 Credits"]: await sset(uid, "a_credit"); await send(cid, tx(la, "a_credit_ask"), kb_back(la)); return
+        if text in ["🔧 تنظیم", "🔧 Set"]: await sset(uid, "a_setcr"); await send(cid, tx(la, "a_setcr_ask"), kb_back(la)); return
+        if text in ["🔎 جستجو", "🔎 Lookup"]: await sset(uid, "a_lookup"); await send(cid, tx(la, "a_lookup_ask"), kb_back(la)); return
+        if text in ["🚫 بن", "🚫 Ban"]: await sset(uid, "a_ban"); await send(cid, tx(la, "a_ban_ask"), kb_back(la)); return
+        if text in ["✅ آنبن", "✅ Unban"]: await sset(uid, "a_unban"); await send(cid, tx(la, "a_unban_ask"), kb_back(la)); return
+        if text in ["📢 پیام", "📢 Broadcast"]: await sset(uid, "a_bcast"); await send(cid, tx(la, "a_bcast_ask"), kb_back(la)); return
 
     # Commands
     if text.startswith("/start"):
         await send(cid, tx(la, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(la, ia)); return
-    if text.startswith("/login"): sset(uid, "phone"); await send(cid, tx(la, "phone_ask"), kb_back(la)); return
+    if text.startswith("/login"): await sset(uid, "phone"); await send(cid, tx(la, "phone_ask"), kb_back(la)); return
     if text.startswith("/logout"): bg.add_task(bg_logout, uid, cid, la); return
+    if text.startswith("/cancel"):
+        ok = jobs.cancel(uid); await cancel_user_jobs(db, uid)
+        await send(cid, tx(la, "job_cancelled" if ok else "job_none"), kb_main(la, ia)); return
     if text.startswith("/lang"):
-        u.lang = "en" if u.lang == "fa" else "fa"; await db.commit()
-        await send(cid, tx(u.lang, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(u.lang, ia)); return
+        la = "en" if la == "fa" else "fa"; await set_lang(db, uid, la)
+        await send(cid, tx(la, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(la, ia)); return
 
     await send(cid, tx(la, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(la, ia))
 
 # ══════════════════════════════
 # CALLBACK HANDLER
 # ══════════════════════════════
-async def on_cb(db, cb, bg: BackgroundTasks):
+async def on_cb(db, cb, bg: BgTasks):
     cbid = cb.get("id", "")
     uid = cb.get("from", {}).get("id")
     fname = cb.get("from", {}).get("first_name", "")
@@ -939,7 +2554,7 @@ async def on_cb(db, cb, bg: BackgroundTasks):
     # Stalk pagination
     if data.startswith("sgp_"):
         page = int(data[4:])
-        _, sd = sget(uid)
+        _, sd = await sget(uid)
         items = sd.get("items", [])
         target_name = sd.get("target_name", "?")
         if items:
@@ -949,32 +2564,91 @@ async def on_cb(db, cb, bg: BackgroundTasks):
         return
 
     # Footprint
-    if data == "fp_scan":
-        if not await has_credit(u): await send(cid, tx(la, "no_credit")); return
-        await use_credit(db, uid)
-        bg.add_task(bg_footprint_scan, uid, cid, la)
+    if data in ("fp_scan", "fp_scan_full"):
+        await start_job(db, u, cid, la, "scan", bg_footprint_scan, uid, cid, la, data == "fp_scan_full")
         return
 
     if data == "fp_delete":
-        _, sd = sget(uid)
-        scan = sd.get("scan", {})
+        _, sd = await sget(uid)
+        scan = sd.get("scan") or {}
         txt = tx(la, "footprint_confirm", msgs=scan.get("total", "?"), gr=len(scan.get("groups", [])))
         await edit(cid, mid, txt, kb_confirm(la))
         return
 
-    if data == "fp_yes":
-        if not await has_credit(u): await send(cid, tx(la, "no_credit")); return
-        await use_credit(db, uid)
-        bg.add_task(bg_footprint_delete, uid, cid, la)
+    if data == "fp_export":
+        await start_job(db, u, cid, la, "export", bg_footprint_export, uid, cid, la, charge=False)
+        return
+
+    if data in ("fp_yes", "fp_yes_pm"):
+        await start_job(db, u, cid, la, "delete", bg_footprint_delete, uid, cid, la, None, data == "fp_yes_pm")
+        return
+
+    # Selective delete
+    if data == "fp_sel":
+        await edit(cid, mid, tx(la, "fp_sel_ask"), kb_fp_select(la))
+        return
+
+    if data.startswith("fp_old_") or data == "fp_media":
+        f = {"media": True} if data == "fp_media" else {"days": int(data[7:])}
+        await supd(uid, filt=f)
+        await edit(cid, mid, tx(la, "footprint_confirm_sel", what=filt_text(la, f)), kb_confirm_sel(la))
+        return
+
+    if data == "fp_pick" or data.startswith("fpkp_") or data.startswith("fpk_"):
+        _, sd = await sget(uid)
+        groups = (sd.get("scan") or {}).get("groups", [])
+        if not groups: await send(cid, tx(la, "fp_need_scan")); return
+        picked = set(sd.get("picked", [])) if data != "fp_pick" else set()
+        page = sd.get("pick_page", 0) if data != "fp_pick" else 0
+        if data.startswith("fpkp_"): page = int(data[5:])
+        elif data.startswith("fpk_"): picked ^= {int(data[4:])}
+        await supd(uid, picked=list(picked), pick_page=page)
+        await edit(cid, mid, tx(la, "fp_pick_ask"), kb_fp_pick(la, groups, picked, page))
+        return
+
+    if data == "fp_pick_go":
+        _, sd = await sget(uid)
+        if not sd.get("picked"): return
+        f = {"groups": sd["picked"]}; await supd(uid, filt=f)
+        await edit(cid, mid, tx(la, "footprint_confirm_sel", what=filt_text(la, f)), kb_confirm_sel(la))
+        return
+
+    if data == "fp_go":
+        _, sd = await sget(uid)
+        if not sd.get("filt"): return
+        await start_job(db, u, cid, la, "delete", bg_footprint_delete, uid, cid, la, None, False, sd["filt"])
+        return
+
+    # Recurring auto-clean
+    if data == "fp_auto":
+        ac = await db.get(AutoCleanDB, uid)
+        st = (("⏸" if ac.paused else "✅") + f" > {ac.days}d" if ac and ac.enabled else "⏹")
+        await edit(cid, mid, tx(la, "auto_menu", every=AUTO_EVERY_HOURS, st=st), kb_autoclean(la))
+        return
+
+    if data in ("fp_auto_30", "fp_auto_90"):
+        if not await get_auth_session(db, uid): await send(cid, tx(la, "not_logged")); return
+        ac = await set_autoclean(db, uid, cid, la, int(data[8:]))
+        await edit(cid, mid, tx(la, "auto_on", days=ac.days, next=ac.next_run.strftime("%Y-%m-%d %H:%M UTC")))
+        return
+
+    if data == "fp_auto_off":
+        await disable_autoclean(db, uid)
+        await edit(cid, mid, tx(la, "auto_off"))
+        return
+
+    if data == "job_cancel":
+        ok = jobs.cancel(uid); await cancel_user_jobs(db, uid)
+        await send(cid, tx(la, "job_cancelled" if ok else "job_none"))
         return
 
     if data == "fp_login":
-        sset(uid, "phone")
+        await sset(uid, "phone")
         await send(cid, tx(la, "phone_ask"), kb_back(la))
         return
 
     if data == "back_main":
-        sdel(uid)
+        await sdel(uid)
         await send(cid, tx(la, "welcome", cr="♾️" if ia else u.credits, used=u.total_used), kb_main(la, ia))
         return
 
@@ -984,8 +2658,9 @@ async def on_cb(db, cb, bg: BackgroundTasks):
 @asynccontextmanager
 async def lifespan(a):
     print("🚀 ShadowClean v5.0")
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    shutil.rmtree(EXPORT_DIR, ignore_errors=True)  # parts left by a crash mid-export
+    get_http(); outbox.start(); updates.start(); jobs.start(); clients.start(); user_cache.start(); ledger.start()
+    if WORKERS == 1: await init_db()  # in multi-worker mode the router ran it once
     # Start bot client
     try:
         await get_bot_client()
@@ -993,31 +2668,89 @@ async def lifespan(a):
     except Exception as e:
         print(f"⚠️ Bot client failed: {e}")
     print(f"✅ DB | Admins: {ADMIN_IDS} | Credits: {DEFAULT_CREDITS}")
+    await resume_jobs()
+    auto_task = spawn(autoclean_loop()); sweep_task = spawn(sweep_states())
     yield
+    auto_task.cancel(); sweep_task.cancel()
+    await updates.stop(); await jobs.stop()
     if bot_client: await bot_client.disconnect()
-    for c in user_clients.values():
-        try: await c.disconnect()
-        except: pass
+    await clients.stop(); await logins.stop(); await user_cache.stop(); await ledger.stop()
+    await outbox.stop(); await close_http()
     await engine.dispose()
     print("🛑 Off")
 
 app = FastAPI(title="ShadowClean v5", lifespan=lifespan)
 
 @app.get("/health")
-async def health(): return {"status": "ok"}
+async def health():
+    return {"status": "ok", "outbox": outbox.stats(), "updates_queued": updates.depth(), "jobs": jobs.stats(),
+            "clients": clients.stats(), "users": user_cache.stats()}
 
 @app.get("/")
 async def root(): return {"ok": True}
 
 @app.post("/webhook")
-async def webhook(request: dict, bg: BackgroundTasks):
-    async with DBS() as db:
-        try:
-            if "message" in request: await on_msg(db, request["message"], bg)
-            elif "callback_query" in request: await on_cb(db, request["callback_query"], bg)
-        except Exception as e:
-            print(f"❌ {e}\n{traceback.format_exc()}")
+async def webhook(request: dict, response: Response):
+    # Ack right away; Telegram redelivers on slow/failed responses, so drop repeats
+    upd_id = request.get("update_id")
+    if upd_id is not None and recent_updates.seen(upd_id): return {"ok": True}
+    if not updates.put(request):
+        if upd_id is not None: recent_updates.forget(upd_id)
+        response.status_code = 503; return {"ok": False}  # let Telegram retry later
     return {"ok": True}
 
+# ══════════════════════════════
+# MULTI-WORKER ROUTER (WORKERS > 1)
+# ══════════════════════════════
+# Every update of a user goes to the same worker, so their state, Telethon client,
+# jobs and per-chat ordering stay in one process without sharing memory.
+worker_procs: List[subprocess.Popen] = []
+
+def worker_port(i): return WORKER_BASE_PORT + i
+
+def start_worker(i):
+    env = dict(os.environ, WORKER_INDEX=str(i), PORT=str(worker_port(i)))
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+async def supervise():
+    while True:
+        await asyncio.sleep(5)
+        for i, p in enumerate(worker_procs):
+            if p.poll() is not None:
+                print(f"⚠️ worker {i} exited ({p.returncode}), restarting"); worker_procs[i] = start_worker(i)
+
+@asynccontextmanager
+async def router_lifespan(a):
+    print(f"🚀 ShadowClean router | {WORKERS} workers")
+    await init_db()
+    open(OUT_BUCKET_FILE, "wb").close()  # fresh send budget; workers fill it on first use
+    worker_procs[:] = [start_worker(i) for i in range(WORKERS)]
+    sup = asyncio.create_task(supervise())
+    yield
+    sup.cancel()
+    for p in worker_procs: p.terminate()
+    for p in worker_procs:
+        try: p.wait(15)
+        except subprocess.TimeoutExpired: p.kill()
+    await close_http(); await engine.dispose()
+
+router = FastAPI(title="ShadowClean router", lifespan=router_lifespan)
+
+@router.get("/health")
+async def router_health():
+    return {"status": "ok", "workers": [p.poll() is None for p in worker_procs]}
+
+@router.post("/webhook")
+async def route_update(request: Request):
+    body = await request.body()
+    try: uid = update_uid(json.loads(body))
+    except ValueError: return {"ok": True}
+    try:
+        r = await get_http().post(f"http://127.0.0.1:{worker_port(uid % WORKERS)}/webhook", content=body,
+                                  headers={"content-type": "application/json"}, timeout=10)
+        return Response(r.content, r.status_code, media_type="application/json")
+    except httpx.HTTPError: return Response(status_code=503)  # worker restarting; Telegram retries
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    if IS_ROUTER: uvicorn.run(router, host="0.0.0.0", port=PORT)
+    else: uvicorn.run(app, host="127.0.0.1" if WORKERS > 1 else "0.0.0.0", port=PORT)